@@ -4,51 +4,96 @@ Created on Tue Apr  2 15:43:09 2023
 
 @author: Nick Ma
 """
-from flask import Flask, request, send_file
+from flask import Flask, request, send_file, Response, stream_with_context, g, has_app_context
+from werkzeug.http import http_date
 from flask_restx import Api, Resource, fields, reqparse, abort, Namespace
-from datetime import datetime
-import requests
+from datetime import datetime, timedelta, timezone
 import sys
-import pandas as pd
-import geopandas as gpd
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
-from sqlalchemy import asc, desc
+import os
+from sqlalchemy import event as sa_event
+from sqlalchemy.orm import sessionmaker, scoped_session, aliased
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
+from sqlalchemy import asc, desc, and_, or_, false, func, insert, select, text, bindparam, literal
 from sqlalchemy.ext.declarative import declarative_base
-import matplotlib.pyplot as plt
 import io
+import re
+import csv
+import json
+import base64
+import binascii
+import hashlib
+import threading
+import time
+import random
+import logging
+from collections import OrderedDict
+from bisect import bisect_right
+from itertools import islice
+from urllib.parse import urlencode
+from intervals import IntervalIndex
+from recurrence import Recurrence, RECURRENCE_HORIZON
+from weather import WeatherCache, WEATHER_TIMEOUT
+from holiday import HolidayProvider
+from geocoding import GeoData
+from metrics import timed, instrument_engine, start_trace, finish_trace, render as render_metrics, Profiler
+from storage import make_engine, migrate, begin_immediate, has_overlap_index, has_text_index, DATABASE_URL, DEFAULT_CALENDAR_ID
 
 
-#Initilize dataset
-def load():
-    #georef-australia-state-suburb.csv
-    georef = sys.argv[1]
-    df_georef = pd.read_csv(georef,sep=';')
-    #au.csv
-    au = sys.argv[2]
-    df_au = pd.read_csv(au)
-    return df_georef, df_au
-
-df_georef, df_au = load()
+#Initilize dataset paths, the datasets are parsed on first use
+GEOREF_PATH = os.environ.get('EVENTS_GEOREF_PATH', 'georef-australia-state-suburb.csv')
+CITIES_PATH = os.environ.get('EVENTS_CITIES_PATH', 'au.csv')
+# holidays from the bundled Holiday-AU.json and holidays.db only, Nager.Date is never called
+HOLIDAYS_OFFLINE = os.environ.get('EVENTS_HOLIDAYS_OFFLINE', '0') == '1'
+geodata = GeoData(GEOREF_PATH, CITIES_PATH)
 
 #Initilize database
 Base = declarative_base()
+class CalendarDB(Base):
+    __tablename__ = "calendars"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    owner = Column(String)
+
+    def __repr__(self):
+        return "<Calendar (id='%s')>" % self.id
+
 class EventDB(Base):
     __tablename__ = "events"
     
     id = Column(Integer, primary_key=True)
+    calendar_id = Column(Integer, ForeignKey('calendars.id'), nullable=False, default=DEFAULT_CALENDAR_ID)
     name = Column(String)
     start_time = Column(DateTime)
     end_time = Column(DateTime)
     description = Column(String)
-    last_updated = Column(DateTime, default=datetime.now())
+    last_updated = Column(DateTime, default=datetime.now, onupdate=datetime.now)
     street = Column(String)
     suburb = Column(String)
     state = Column(String)
     post_code = Column(String)
+    # recurring events: the row is the first occurrence, series_end the end of the last one (NULL if endless)
+    rrule = Column(String)
+    exdates = Column(String)
+    series_end = Column(DateTime)
+    # bumped by every ORM update, an update of a row changed meanwhile raises StaleDataError
+    version = Column(Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        Index('ix_events_start_end', 'start_time', 'end_time'),
+        Index('ix_events_calendar_start', 'calendar_id', 'start_time'),
+        Index('ix_events_state_start', 'state', 'start_time'),
+        Index('ix_events_recurring', 'start_time', sqlite_where=text('rrule IS NOT NULL'),
+              postgresql_where=text('rrule IS NOT NULL')),
+    )
+    __mapper_args__ = {'version_id_col': version}
 
-    def __init__(self, name, start_time, end_time, description, street, suburb, state, post_code):
+    def __init__(self, name, start_time, end_time, description, street, suburb, state, post_code, recurrence=None,
+                 calendar_id=DEFAULT_CALENDAR_ID):
+        self.calendar_id = calendar_id
         self.name = name
         self.start_time = start_time
         self.end_time = end_time
@@ -57,22 +102,179 @@ class EventDB(Base):
         self.suburb = suburb
         self.state = state
         self.post_code = post_code
+        self.set_recurrence(recurrence)
         
     def __repr__(self):
         return "<Event (id='%s')>" % self.id
+
+    @property
+    def recurrence(self):
+        return Recurrence.parse(self.rrule, self.exdates) if self.rrule else None
+
+    # store the rule, must be called again whenever start_time or end_time change
+    def set_recurrence(self, recurrence):
+        self.rrule = recurrence.rule if recurrence is not None else None
+        self.exdates = ','.join(recurrence.exceptions) if recurrence is not None else None
+        self.series_end = recurrence.last_end(self.start_time, self.end_time) if recurrence is not None else None
     
-engine = create_engine("sqlite+pysqlite:///events.db", echo=True, future=True)
-Base.metadata.drop_all(engine)
-Base.metadata.create_all(engine)
-Session = sessionmaker(engine)
-    
+# bound to a database by init_database when the app is created
+engine = None
+database_url = None
+Session = sessionmaker()
+use_rtree = False
+use_fts = False
+# request-scoped session, removed when the app context of the request is torn down
+db_session = scoped_session(Session)
+session_metrics = {'requests': 0, 'sessions': 0, 'max-sessions-per-request': 0}
+
+# in-process interval index of the committed events of each calendar, kept in sync with commits
+interval_indexes = {}
+# bumped on every commit touching a calendar, cached statistics of older versions are never read again
+calendar_versions = {}
+calendar_ids = set()
+
+def calendar_index(calendar_id):
+    return interval_indexes.setdefault(calendar_id, IntervalIndex())
+
+def load_interval_index():
+    session = Session()
+    rows = {}
+    for calendar_id, event_id, start_time, end_time, rrule, exdates in session.query(
+            EventDB.calendar_id, EventDB.id, EventDB.start_time, EventDB.end_time, EventDB.rrule, EventDB.exdates):
+        rows.setdefault(calendar_id, []).append(
+            (event_id, start_time, end_time, Recurrence.parse(rrule, exdates) if rrule else None))
+    for calendar_id, calendar_rows in rows.items():
+        calendar_index(calendar_id).load(calendar_rows)
+    calendar_ids.update(calendar_id for calendar_id, in session.query(CalendarDB.id))
+    session.close()
+
+# collect event changes at flush time, apply them to the index only on commit
+@sa_event.listens_for(Session, 'after_flush')
+def record_interval_changes(session, flush_context):
+    changes = session.info.setdefault('interval_changes', [])
+    for obj in session.new | session.dirty:
+        if isinstance(obj, EventDB):
+            changes.append((obj.calendar_id, obj.id, obj.start_time, obj.end_time, obj.recurrence))
+    for obj in session.deleted:
+        if isinstance(obj, EventDB):
+            changes.append((obj.calendar_id, obj.id, None, None, None))
+
+@sa_event.listens_for(Session, 'after_commit')
+def apply_interval_changes(session):
+    for calendar_id, event_id, start_time, end_time, recurrence in session.info.pop('interval_changes', []):
+        if start_time is None:
+            calendar_index(calendar_id).remove(event_id)
+        else:
+            calendar_index(calendar_id).add(event_id, start_time, end_time, recurrence)
+        calendar_versions[calendar_id] = calendar_versions.get(calendar_id, 0) + 1
+        invalidate_responses(calendar_id)
+
+@sa_event.listens_for(Session, 'after_rollback')
+def discard_interval_changes(session):
+    session.info.pop('interval_changes', None)
 
-# Initilize application
-app = Flask(__name__)
-api = Api(app, version='1.0', title="Nick Ma's MyCalender API",
-    description='the best time-management and scheduling calendar service for Australians',
-    default='Events', default_label='all events related methods are listed here'
-)
+# remember which sessions a request opened, for the sessions per request metric
+@sa_event.listens_for(Session, 'after_begin')
+def count_request_sessions(session, transaction, connection):
+    if has_app_context():
+        g.setdefault('db_sessions', set()).add(id(session))
+
+# connect to the database, create missing tables, then bring an existing database up to date, data is never dropped
+def init_database(url=DATABASE_URL):
+    global engine, database_url, use_rtree, use_fts
+    if engine is not None:
+        engine.dispose()
+    engine = make_engine(url)
+    database_url = url
+    instrument_engine(engine)
+    Base.metadata.create_all(engine)
+    migrate(engine)
+    Session.configure(bind=engine)
+    use_rtree = has_overlap_index(engine)
+    use_fts = has_text_index(engine)
+    interval_indexes.clear()
+    calendar_versions.clear()
+    response_cache.clear()
+    calendar_ids.clear()
+    load_interval_index()
+
+
+# Initilize application, the routes live on a namespace added to the app by create_app
+DEFAULT_CONFIG = {
+    'DATABASE_URL': DATABASE_URL,
+    'GEOREF_PATH': GEOREF_PATH,
+    'CITIES_PATH': CITIES_PATH,
+    'PRELOAD_DATASETS': False,   # parse the datasets before the first request instead of during it
+    'PRELOAD_HOLIDAYS': True,
+    'HOLIDAYS_OFFLINE': HOLIDAYS_OFFLINE,
+}
+api = Namespace('Events', description='all events related methods are listed here', path='/')
+
+def create_app(config=None):
+    global geodata, holiday_provider
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    # the datasets are parsed on first use, a missing file stops the app here rather than failing every request
+    for path_key in ('GEOREF_PATH', 'CITIES_PATH'):
+        if not os.path.isfile(config[path_key]):
+            raise FileNotFoundError(path_key + ' ' + str(config[path_key]) + ' does not exist')
+    app = Flask(__name__)
+    app.config.update(config)
+    rest_api = Api(app, version='1.0', title="Nick Ma's MyCalender API",
+        description='the best time-management and scheduling calendar service for Australians')
+    rest_api.add_namespace(api)
+    app.before_request(start_request_trace)
+    app.after_request(record_request_trace)
+    app.after_request(record_session_metrics)
+    app.teardown_appcontext(remove_session)
+
+    # one database per process, apps created again for the same database share it
+    if config['DATABASE_URL'] != database_url:
+        init_database(config['DATABASE_URL'])
+    if (geodata.georef_path, geodata.cities_path) != (config['GEOREF_PATH'], config['CITIES_PATH']):
+        geodata = GeoData(config['GEOREF_PATH'], config['CITIES_PATH'])
+    if holiday_provider.offline != config['HOLIDAYS_OFFLINE']:
+        holiday_provider = HolidayProvider('AU', offline=config['HOLIDAYS_OFFLINE'])
+    if config['PRELOAD_DATASETS']:
+        geodata.preload()
+    if config['PRELOAD_HOLIDAYS']:
+        holiday_provider.preload([datetime.now().year, datetime.now().year + 1])
+    return app
+
+logger = logging.getLogger(__name__)
+timing_logger = logging.getLogger('events.timing')
+profiler = Profiler()
+
+# time the request, a sampled fraction also runs under the profiler
+def start_request_trace():
+    g.trace, g.trace_token = start_trace()
+    g.profile = profiler.start()
+
+def record_request_trace(response):
+    if 'trace_token' not in g:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    trace = finish_trace(g.pop('trace_token'), request.method, endpoint, response.status_code)
+    g.pop('trace')
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile_path = profiler.stop(profile, request.method + ' ' + endpoint)
+        timing_logger.info('profile of %s %s written to %s', request.method, request.path, profile_path)
+    response.headers['Server-Timing'] = trace.server_timing()
+    if timing_logger.isEnabledFor(logging.INFO):
+        timing_logger.info(json.dumps(dict(trace.as_dict(), method=request.method, path=request.path,
+                                           endpoint=endpoint, status=response.status_code)))
+    return response
+
+def record_session_metrics(response):
+    sessions = len(g.pop('db_sessions', ()))
+    session_metrics['requests'] += 1
+    session_metrics['sessions'] += sessions
+    session_metrics['max-sessions-per-request'] = max(session_metrics['max-sessions-per-request'], sessions)
+    response.headers['X-DB-Sessions'] = str(sessions)
+    return response
+
+def remove_session(exception=None):
+    db_session.remove()
 
 
 
@@ -84,17 +286,62 @@ location = api.model('Location', {
     'post-code': fields.String(required=True)
 })
 
+calendar = api.model('Calendar', {
+    'name': fields.String(required=True),
+    'owner': fields.String
+})
+
+recurrence_rule = api.model('Recurrence', {
+    'rule': fields.String(description='FREQ=DAILY|WEEKLY|MONTHLY with INTERVAL and COUNT or UNTIL, e.g. FREQ=WEEKLY;COUNT=10'),
+    'exceptions': fields.List(fields.String, description='excluded dates, YYYY-MM-DD')
+})
+
 event = api.model('Event', {
     'name': fields.String(required=True),
     'date': fields.Date(required=True),
     'from': fields.DateTime(required=True),
     'to': fields.DateTime(required=True),
     'location': fields.Nested(location),
-    'description': fields.String
+    'description': fields.String,
+    'recurrence': fields.Nested(recurrence_rule)
 })
 
 # global variables
 events_list = []
+weather_cache = WeatherCache()
+holiday_provider = HolidayProvider('AU', offline=HOLIDAYS_OFFLINE)
+chart_cache = OrderedDict()
+chart_cache_lock = threading.Lock()
+CHART_CACHE_SIZE = 32
+statistics_cache = OrderedDict()
+statistics_cache_lock = threading.Lock()
+STATISTICS_CACHE_SIZE = 256
+# rendered GET /events and /events/<id> bodies, dropped on commits touching their calendar
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 60     # seconds, bounds how stale the forecasts and the writes of other processes can be
+BULK_CHUNK_SIZE = 1000
+BULK_MAX_ERRORS = 100
+EXPORT_FIELDS = ['id', 'name', 'date', 'from', 'to', 'street', 'suburb', 'state', 'post-code', 'description', 'recurrence',
+                 'exceptions', 'last-update']
+# columns GET /events may return and order by, anything else is rejected with a 400
+LIST_FIELDS = ['id', 'calendar_id', 'name', 'start_time', 'end_time', 'description', 'last_updated', 'street', 'suburb', 'state',
+               'post_code', 'rrule', 'exdates', 'series_end']
+ORDER_FIELDS = LIST_FIELDS + ['datetime']
+WEATHER_FLAGS = {'': False, '0': False, 'false': False, '1': True, 'true': True}
+MAX_WEATHER_IDS = 100   # events per GET /events/weather
+FREE_SLOT_DAYS = 14             # window searched when to is omitted
+MAX_FREE_SLOT_DAYS = 366
+MAX_FREE_SLOTS = 100
+FREE_SLOT_EXCLUSIONS = ['weekends', 'holidays']
+# events sharing even an instant overlap, so a free range starts a second after one event and ends a second before the next
+BOOKING_RESOLUTION = timedelta(seconds=1)
+MAX_EVENT_SPAN = timedelta(days=1)   # events start and end on the same date
+WRITE_RETRIES = 3           # attempts of a write that lost a race with another writer
+WRITE_RETRY_DELAY = 0.05    # seconds before the second attempt, doubled for each further one
+LAST_CODE_POINT = chr(0x10FFFF)
+PREDICATE_ARGS = ['calendar', 'from', 'to', 'state', 'suburb', 'name', 'q']
 DATE_FORMAT_PATTERN = r'^\d{2}-\d{2}-\d{4}$'
 TIME_FORMAT_PATTERN = r'^\d{2}:\d{2}:\d{2}$'
 
@@ -121,82 +368,719 @@ def state_name_converter(state_in):
         raise ValueError('Input is not a state')
     return state_out
         
-# help function - used to detect overlapping when creating event
-def detect_overlapping(start_time, end_time):
-    session = Session()
-    overlap = session.query(EventDB).filter(
-        ((EventDB.start_time >= start_time) & (EventDB.start_time <= end_time)) |
-        ((EventDB.end_time >= start_time) & (EventDB.end_time <= end_time)) |
-        (((EventDB.start_time <= start_time) & (EventDB.end_time >= end_time)))
-    )
-    count = overlap.count()
-    return True if count > 0 else False
+# help function - id of the calendar named by the calendar query argument, the default calendar when absent
+def calendar_arg(session, args):
+    try:
+        calendar_id = int(args.get('calendar', DEFAULT_CALENDAR_ID))
+    except ValueError:
+        abort(400, 'Invalid calendar, please use a calendar id.')
+    # calendars created by another process are not in the set yet
+    if calendar_id not in calendar_ids:
+        if session.query(CalendarDB.id).filter_by(id=calendar_id).first() is None:
+            abort(404, 'Calendar not found')
+        calendar_ids.add(calendar_id)
+    return calendar_id
+
+# help function - used to detect overlapping when creating event, returns the conflicting event ids of the calendar
+# a recurring event is checked occurrence by occurrence, endless rules up to RECURRENCE_HORIZON ahead
+@timed
+def detect_overlapping(calendar_id, start_time, end_time, exclude_id=None, recurrence=None):
+    return index_overlapping(calendar_index(calendar_id), start_time, end_time, exclude_id, recurrence)
+
+# help function - conflicting ids of an interval index, a recurring event is checked occurrence by occurrence
+def index_overlapping(interval_index, start_time, end_time, exclude_id=None, recurrence=None):
+    if recurrence is None:
+        return interval_index.overlapping(start_time, end_time, exclude_id)
+    horizon_end = max(start_time, datetime.now()) + RECURRENCE_HORIZON
+    return interval_index.overlapping_series(start_time, end_time, recurrence, exclude_id, horizon_end)
+
+# help function - interval index of the events of a calendar sharing an instant with [start_time, end_time],
+# as committed in the database: one-off events by a (calendar_id, start_time) range, series through their own index
+def stored_interval_index(session, calendar_id, start_time, end_time):
+    columns = (EventDB.id, EventDB.start_time, EventDB.end_time, EventDB.rrule, EventDB.exdates)
+    one_off = session.query(*columns).filter(
+        EventDB.calendar_id == calendar_id, EventDB.start_time >= start_time - MAX_EVENT_SPAN,
+        EventDB.start_time <= end_time, EventDB.end_time >= start_time, EventDB.rrule.is_(None))
+    # calendar_id + 0 keeps the planner off ix_events_calendar_start, which would read every earlier event
+    series = session.query(*columns).filter(
+        EventDB.rrule.isnot(None), EventDB.start_time <= end_time, EventDB.calendar_id + 0 == calendar_id,
+        or_(EventDB.series_end.is_(None), EventDB.series_end >= start_time))
+    interval_index = IntervalIndex()
+    interval_index.load((event_id, row_start, row_end, Recurrence.parse(rrule, exdates) if rrule else None)
+                        for event_id, row_start, row_end, rrule, exdates in one_off.all() + series.all())
+    return interval_index
+
+# help function - conflicting event ids of a calendar as committed in the database, series included
+# the in-process index misses commits of other processes, so writes run this check once the calendar is locked
+@timed
+def stored_overlapping(session, calendar_id, start_time, end_time, exclude_id=None, recurrence=None):
+    interval_index = stored_interval_index(session, calendar_id, start_time, overlap_window_end(start_time, end_time, recurrence))
+    return index_overlapping(interval_index, start_time, end_time, exclude_id, recurrence)
+
+# help function - end of the window an event is checked for overlaps in, endless rules up to RECURRENCE_HORIZON ahead
+def overlap_window_end(start_time, end_time, recurrence=None):
+    if recurrence is None:
+        return end_time
+    return recurrence.last_end(start_time, end_time) or max(start_time, datetime.now()) + RECURRENCE_HORIZON
+
+# help function - hold the write lock of a calendar until the transaction ends: a row lock on the calendar,
+# on SQLite the database write lock as row locks do not exist there
+def lock_calendar(session, calendar_id):
+    connection = session.connection()
+    if connection.dialect.name == 'sqlite':
+        begin_immediate(connection)
+    else:
+        session.query(CalendarDB.id).filter_by(id=calendar_id).with_for_update().first()
+
+# help function - an event re-read once its calendar is locked, None when it does not exist
+def lock_event(session, event_id):
+    calendar_id = session.query(EventDB.calendar_id).filter_by(id=event_id).scalar()
+    if calendar_id is None:
+        return None
+    lock_calendar(session, calendar_id)
+    return session.query(EventDB).filter_by(id=event_id).populate_existing().first()
+
+# help function - whether an If-Match header names the current version of an event,
+# the version is the part of an event etag before the first dash, a bare version matches as well
+def version_matches(if_match, version):
+    return if_match.star_tag or any(tag.split('-', 1)[0] == str(version) for tag in if_match.as_set())
+
+# help function - run write() as one transaction, from the start again when it lost a race with another writer:
+# the row changed under it (StaleDataError) or the lock was not granted in time (OperationalError)
+def retry_on_conflict(session, write):
+    for attempt in range(WRITE_RETRIES):
+        try:
+            return write()
+        except HTTPException:
+            session.rollback()
+            raise
+        except (StaleDataError, OperationalError) as err:
+            session.rollback()
+            if attempt == WRITE_RETRIES - 1:
+                if isinstance(err, StaleDataError):
+                    abort(409, 'The event was changed by a concurrent request, please retry.')
+                abort(503, 'The database is busy, please retry.')
+            time.sleep(WRITE_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+
+# help function - conflicting event ids straight from the database, through the R*Tree on SQLite
+@timed
+def query_overlapping(session, calendar_id, start_time, end_time, exclude_id=None):
+    if use_rtree:
+        probe = text(
+            "SELECT e.id FROM events_rtree r CROSS JOIN events e ON e.id = r.id "
+            "WHERE r.start_time <= CAST(strftime('%s', :end_time) AS INTEGER) "
+            "AND r.end_time >= CAST(strftime('%s', :start_time) AS INTEGER) "
+            "AND r.calendar_lo <= :calendar_id AND r.calendar_hi >= :calendar_id AND e.calendar_id = :calendar_id "
+            "AND e.start_time <= :end_time AND e.end_time >= :start_time"
+        ).bindparams(bindparam('start_time', type_=DateTime), bindparam('end_time', type_=DateTime))
+        rows = session.execute(probe, {'start_time': start_time, 'end_time': end_time, 'calendar_id': calendar_id})
+    else:
+        rows = session.query(EventDB.id).filter(EventDB.calendar_id == calendar_id,
+                                                EventDB.start_time <= end_time, EventDB.end_time >= start_time)
+    return [event_id for event_id, in rows if event_id != exclude_id]
+
+# help function - commit, turning an overlap rejected by the database into a 409 with the conflicting ids
+def commit_or_conflict(session, calendar_id, start_time, end_time, exclude_id=None):
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        abort(409, 'Events overlapping detected.',
+              conflicts=query_overlapping(session, calendar_id, start_time, end_time, exclude_id))
 
 # help function - used to detect overlapping when updating event
 def detect_overlapping_patch(current_event, start_time, end_time):
-    is_overlap = False
-    session = Session()
-    overlap = session.query(EventDB).filter(
-        ((EventDB.start_time >= start_time) & (EventDB.start_time <= end_time)) |
-        ((EventDB.end_time >= start_time) & (EventDB.end_time <= end_time)) |
-        (((EventDB.start_time <= start_time) & (EventDB.end_time >= end_time)))
-    )
-    count = overlap.count()
-    if count > 1 :
-        is_overlap =True
-    elif count == 1:
-        found_event = overlap.first()
-        is_overlap = False if found_event.id == current_event.id else True
-    else:
-        pass
-    return is_overlap
+    return detect_overlapping(current_event.calendar_id, start_time, end_time, exclude_id=current_event.id,
+                              recurrence=current_event.recurrence)
+
+# help function - recurrence of a POST or PATCH body {"rule": "FREQ=WEEKLY;COUNT=10", "exceptions": ["YYYY-MM-DD"]}
+def parse_recurrence(value, start_time, end_time):
+    if value is None or not value.get('rule'):
+        return None
+    try:
+        return recurrence_of(value['rule'], value.get('exceptions'), start_time, end_time)
+    except ValueError as err:
+        abort(400, 'Invalid recurrence: ' + str(err))
+
+# help function - recurrence of a rule and its excluded dates, raises ValueError when it is invalid or has no occurrences
+def recurrence_of(rule, exceptions, start_time, end_time):
+    try:
+        recurrence = Recurrence.parse(rule, exceptions)
+        recurrence.last_end(start_time, end_time)
+    except TypeError as err:
+        raise ValueError(str(err))
+    if next(recurrence.occurrences(start_time, end_time), None) is None:
+        raise ValueError('the rule has no occurrences.')
+    return recurrence
     
-# help function - find next and prev events
-def find_adjacency(current_event):
-    session = Session()
-    start_time = current_event.start_time
-    end_time = current_event.end_time
-    previous_event = session.query(EventDB).filter(EventDB.start_time < start_time).order_by(EventDB.start_time.desc()).first()
-    next_event = session.query(EventDB).filter(EventDB.start_time > start_time).order_by(EventDB.start_time.asc()).first()
-    return previous_event, next_event
-
-# help function - query weather from external API
-def weatherAPI(event_id):
-    session = Session()
-    url = "http://www.7timer.info/bin/api.pl?"
-    event = session.query(EventDB).filter_by(id=event_id).first()
-    place = df_georef[df_georef['Official Name Suburb'] == event.suburb]
-    time = event.start_time.strftime('%Y%m%d%H')
-    lon = place['Geo Point'].iloc[0].split(', ')[1]
-    lat = place['Geo Point'].iloc[0].split(', ')[0]
-    url = url + 'lon=' + str(lon) +'&lat=' + str(lat) + '&product=civil&output=json'
-    response = requests.get(url)
-    info = {}
-    if response.status_code == 200:
-        res = response.json()
-        target_time = (int(time) - int(res['init']))
-        for forecast in res['dataseries']:
-            if forecast['timepoint'] > target_time - 3 and forecast['timepoint'] <= target_time:
-                info = forecast
-    return info
+# help function - find an event with the ids of its prev and next events in its calendar in one round trip
+# each neighbour is a correlated ORDER BY start_time LIMIT 1 subquery, i.e. a seek on the (calendar_id, start_time) index
+@timed
+def find_adjacency(session, event_id):
+    other = aliased(EventDB)
+    previous_id = select(other.id).where(other.calendar_id == EventDB.calendar_id, other.start_time < EventDB.start_time) \
+        .order_by(other.start_time.desc()).limit(1).correlate(EventDB).scalar_subquery()
+    next_id = select(other.id).where(other.calendar_id == EventDB.calendar_id, other.start_time > EventDB.start_time) \
+        .order_by(other.start_time.asc()).limit(1).correlate(EventDB).scalar_subquery()
+    row = session.query(EventDB, previous_id.label('previous_id'), next_id.label('next_id')) \
+        .filter(EventDB.id == event_id).first()
+    return row if row is not None else (None, None, None)
+
+# help function - query weather from external API, served from the forecast cache
+@timed
+def weatherAPI(event):
+    place = event_place(event)
+    if place is None:
+        return {}
+    lat, lon = place
+    return forecast_at(weather_cache.get(lat, lon, 'civil'), event.start_time)
+
+# help function - (lat, lon) of the suburb of an event, None when it is unknown or the gazetteer cannot be loaded,
+# so the event is served with its weather *not available*
+def event_place(event):
+    try:
+        return geodata.suburbs.lookup(event.suburb, event.state)
+    except (OSError, KeyError, ValueError) as err:
+        logger.warning('suburb gazetteer %s cannot be loaded: %s', geodata.georef_path, err)
+        return None
+
+# help function - the 3-hourly forecast covering start_time in a 7timer civil document,
+# None while the document has not arrived, as opposed to {} when it holds no forecast for start_time
+def forecast_at(res, start_time):
+    if res is None:
+        return None
+    return timeline_at(forecast_timeline(res), start_time)
+
+# help function - (init time, sorted timepoints, dataseries) of a 7timer document, or None
+def forecast_timeline(res):
+    if res is None:
+        return None
+    try:
+        init = datetime.strptime(str(res['init']), '%Y%m%d%H')
+        dataseries = sorted(res['dataseries'], key=lambda forecast: forecast['timepoint'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return init, [forecast['timepoint'] for forecast in dataseries], dataseries
+
+# help function - the forecast whose 3-hour step covers start_time, found by bisecting the timepoints;
+# timepoints are hours after init, so the offset is taken on datetimes rather than on YYYYMMDDHH digits
+def timeline_at(timeline, start_time):
+    if timeline is None:
+        return {}
+    init, timepoints, dataseries = timeline
+    target_time = (start_time - init).total_seconds() / 3600
+    i = bisect_right(timepoints, target_time) - 1
+    if i < 0 or timepoints[i] <= target_time - 3:
+        return {}
+    return dataseries[i]
+
+# help function - the grid cell of every event, (distinct cell locations, cell position per event or None)
+def weather_cells(events):
+    cells = {}
+    event_cells = []
+    for event in events:
+        place = event_place(event)
+        if place is None:
+            event_cells.append(None)
+            continue
+        key = weather_cache.key(*place, 'civil')
+        if key not in cells:
+            cells[key] = (len(cells), place)
+        event_cells.append(cells[key][0])
+    return [place for _, place in cells.values()], event_cells
+
+# help function - the forecast of every event, each cell's dataseries indexed once and shared by its events,
+# None for an event whose cell's document has not arrived as in forecast_at
+def events_weather(events, event_cells, forecasts):
+    timelines = [forecast_timeline(forecast) for forecast in forecasts]
+    return [{} if cell is None else None if forecasts[cell] is None else timeline_at(timelines[cell], event.start_time)
+            for event, cell in zip(events, event_cells)]
+
+# help function - whether a body can be cached: every forecast it shows has arrived, a body rendered while
+# one is still on its way would hide it for RESPONSE_CACHE_TTL once it lands in the forecast cache
+def weather_final(weather):
+    return weather is None or all(weather_info is not None for weather_info in weather)
+
+# help function - forecasts of many events, one civil request per grid cell
+@timed
+def batch_weather(events):
+    locations, event_cells = weather_cells(events)
+    forecasts = weather_cache.get_many(locations, 'civil') if locations else []
+    return events_weather(events, event_cells, forecasts)
     
-# help function - query holiday information from external API
-def holidayAPI(event_id):
-    session = Session()
-    holiday_name = "*Not a holiday*"
-    event = session.query(EventDB).filter_by(id=event_id).first()
-    year = event.start_time.strftime('%Y')
-    date = event.start_time.strftime('%Y-%m-%d')
-    state = 'AU-' + event.state
-    url = "https://date.nager.at/api/v2/publicholidays/" + year + "/AU"
-    response = requests.get(url)
-    if response.status_code == 200:
-        res = response.json()
-        for holiday in res:
-            if holiday['date'] == date and (holiday['counties'] == None or state in holiday['counties']):
-                holiday_name = holiday['name']
-    return holiday_name
+# help function - query holiday information from the preloaded holiday tables
+@timed
+def holidayAPI(event):
+    holiday_name = holiday_provider.lookup(event.start_time.date(), event.state)
+    return holiday_name if holiday_name is not None else "*Not a holiday*"
     
+# help function - distinct event ids of GET /events/weather, in request order
+def weather_ids(args):
+    try:
+        event_ids = list(dict.fromkeys(int(event_id) for event_id in args.get('ids', '').split(',') if event_id.strip()))
+    except ValueError:
+        abort(400, 'Invalid ids, please use comma separated event ids.')
+    if not event_ids or len(event_ids) > MAX_WEATHER_IDS:
+        abort(400, 'Please give between 1 and ' + str(MAX_WEATHER_IDS) + ' event ids.')
+    return event_ids
+
+# help function - GET /events/weather response, events in request order and ids that do not exist
+def events_weather_response(event_ids, events, weather):
+    found = {event.id: (event, weather_info) for event, weather_info in zip(events, weather)}
+    result = []
+    for event_id in event_ids:
+        if event_id not in found:
+            continue
+        event, weather_info = found[event_id]
+        result.append({
+            'id': event.id,
+            'date': str(event.start_time.date()),
+            'from': str(event.start_time.time()),
+            '_metadata': weather_metadata(weather_info),
+            '_links': {
+                'self': {
+                    'href': '/events/' + str(event.id)
+                }
+            }
+        })
+    return {
+        'events': result,
+        'not-found': [event_id for event_id in event_ids if event_id not in found]
+    }
+
+# help function - wind, weather, humidity and temperature of one forecast step for _metadata
+def weather_metadata(weather_info):
+    try:
+        wind_speed = weather_info['wind10m']['speed']
+        weather = weather_info['weather']
+        humidity = weather_info['rh2m']
+        temperature = weather_info['temp2m']
+    except:
+        index_error_msg = "*not available*"
+        wind_speed = index_error_msg
+        weather = index_error_msg
+        humidity = index_error_msg
+        temperature = index_error_msg
+    return {
+        "wind-speed": str(wind_speed) + " KM",
+        "weather": weather,
+        "humidity": humidity,
+        "temperature": str(temperature) + " C",
+    }
+
+# help function - detail representation of an event with its enrichment and neighbour links
+def event_detail(event, previous_id, next_id, weather_info, holiday_name):
+    prev_url = '/events/' + str(previous_id) if previous_id is not None else 'no existing event'
+    next_url = '/events/' + str(next_id) if next_id is not None else 'no existing event'
+
+    event_response = {
+        'id': event.id,
+        'name': event.name,
+        'date': str(event.start_time.date()),
+        'from': str(event.start_time.time()),
+        'to': str(event.end_time.time()),
+        'location': {
+            'street': event.street,
+            'suburb': event.suburb,
+            'state': event.state,
+            'post-code': event.post_code
+            },
+        'description': event.description,
+        'last-update': str(event.last_updated),
+        "_metadata" : dict(weather_metadata(weather_info), **{
+              "holiday": holiday_name,
+              "weekend": check_weekend(event.start_time)
+            }),
+        '_links': {
+            'self': {
+                'href': '/events/' + str(event.id)
+            },
+            'calendar': {
+                'href': '/calendars/' + str(event.calendar_id)
+            },
+            'previous': {
+                'href': prev_url
+            },
+            'next': {
+                'href': next_url
+            }
+        }
+    }
+    recurrence = event.recurrence
+    if recurrence is not None:
+        event_response['recurrence'] = {'rule': recurrence.rule, 'exceptions': recurrence.exceptions}
+        event_response['_links']['occurrences'] = {'href': '/events/' + str(event.id) + '/occurrences'}
+
+    return event_response
+
+# help function - opaque keyset cursor holding the sort key values of the last row on a page
+def encode_cursor(order_str, values):
+    payload = {'order': order_str, 'keys': [value.isoformat() if isinstance(value, datetime) else value for value in values]}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, order_str, order_keys):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        values = payload['keys']
+    except (TypeError, KeyError, binascii.Error, UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError('malformed cursor')
+    if payload.get('order') != order_str or len(values) != len(order_keys):
+        raise ValueError('cursor does not match the ordering')
+    return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) and value is not None else value
+            for (column, _), value in zip(order_keys, values)]
+
+# help function - rows strictly after the cursor: (k1 > v1) or (k1 = v1 and k2 > v2) or ...
+def keyset_filter(order_keys, values):
+    clauses = []
+    for i, (column, order_direction) in enumerate(order_keys):
+        equal_prefix = [keyset_equal(order_keys[j][0], values[j]) for j in range(i)]
+        clauses.append(and_(*equal_prefix, keyset_after(column, order_direction, values[i])))
+    return or_(*clauses)
+
+# help function - a column equal to a cursor value, NULL included
+def keyset_equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+# help function - a column strictly after a cursor value in the database's NULL ordering:
+# NULLs sort as the smallest value on SQLite and as the largest on PostgreSQL
+def keyset_after(column, order_direction, value):
+    nulls_first = (engine.dialect.name != 'postgresql') == (order_direction is asc)
+    if value is None:
+        return column.isnot(None) if nulls_first else false()
+    after = column < value if order_direction is desc else column > value
+    return after if nulls_first else or_(after, column.is_(None))
+
+# help function - server-side predicates of the from, to, state, suburb, name and q query arguments
+# each one maps onto an index: (start_time), (state, start_time), lower(suburb), lower(name) and the description text index
+def event_predicates(args):
+    predicates = []
+    try:
+        date_from = datetime.strptime(args['from'], '%Y-%m-%d') if 'from' in args else None
+        date_to = datetime.strptime(args['to'], '%Y-%m-%d') + timedelta(days=1) if 'to' in args else None
+    except ValueError:
+        abort(400, 'Incorrect date format. Please use YYYY-MM-DD for from and to.')
+    if date_from is not None or date_to is not None:
+        # one-off events starting in the window, recurring events whose span reaches into it
+        one_off = [EventDB.rrule.is_(None)]
+        recurring = [EventDB.rrule.isnot(None)]
+        if date_from is not None:
+            one_off.append(EventDB.start_time >= date_from)
+            recurring.append(or_(EventDB.series_end.is_(None), EventDB.series_end >= date_from))
+        if date_to is not None:
+            one_off.append(EventDB.start_time < date_to)
+            recurring.append(EventDB.start_time < date_to)
+        predicates.append(or_(and_(*one_off), and_(*recurring)))
+    if 'state' in args:
+        try:
+            predicates.append(EventDB.state == state_name_converter(args['state']))
+        except ValueError:
+            abort(400, 'Invalid state name, please use Australian states and territories')
+    # case is folded by the database on both sides, SQLite's lower() only folds ASCII while Python's folds all letters
+    if 'suburb' in args:
+        predicates.append(func.lower(EventDB.suburb) == func.lower(literal(args['suburb'].strip(), String)))
+    if args.get('name'):
+        # LIKE matches the prefix, the range around it keeps it an index seek on lower(name) on every database:
+        # a name continuing the prefix sorts before the prefix followed by the last code point, a noncharacter
+        prefix = func.lower(literal(args['name'], String), type_=String)
+        escaped = func.lower(literal(re.sub(r'([\\%_])', r'\\\1', args['name']), String), type_=String)
+        predicates.append(func.lower(EventDB.name) >= prefix)
+        predicates.append(func.lower(EventDB.name) < prefix + LAST_CODE_POINT)
+        predicates.append(func.lower(EventDB.name).like(escaped + '%', escape='\\'))
+    # a q of only whitespace has no words to match and filters nothing
+    if args.get('q', '').split():
+        predicates.append(description_matches(args['q']))
+    return predicates
+
+# help function - full text match on the description, through FTS5 on SQLite and a tsvector index on PostgreSQL
+def description_matches(terms):
+    words = terms.split()
+    if use_fts:
+        # every word quoted, so user input is never parsed as FTS5 query syntax
+        match = ' '.join('"' + word.replace('"', '""') + '"' for word in words)
+        return EventDB.id.in_(text("SELECT rowid FROM events_fts WHERE events_fts MATCH :match").bindparams(match=match))
+    if engine.dialect.name == 'postgresql':
+        document = func.to_tsvector('simple', func.coalesce(EventDB.description, ''))
+        return document.op('@@')(func.plainto_tsquery('simple', terms))
+    return and_(*[EventDB.description.ilike('%' + word + '%') for word in words])
+
+# help function - one page of events for the order, page, size, filter and cursor query arguments,
+# with the forecasts shown on it (None without weather); only the requested and ordering columns are selected
+@timed
+def list_events(session, args):
+    page = query_event_page(session, args)
+    weather = batch_weather(page['events']) if page['weather'] else None
+    return event_page_response(page, weather), weather
+
+# help function - validate the list arguments and read one page of events
+def query_event_page(session, args):
+    try:
+        order_str = args.get('order', '+id').replace(' ', '+')
+        order_list = list(dict.fromkeys(order_str.split(',')))
+        page = int(args.get('page', 1))
+        size = int(args.get('size', 10))
+        filter_str = args.get('filter', 'id,name')
+        filter_list = list(dict.fromkeys(filter_str.split(',')))
+    except ValueError:
+        abort(400, 'Invalid query, please use order, page, size and filter only.')
+    if page < 1 or size < 1:
+        abort(400, 'Invalid query, page and size must be positive.')
+    cursor = args.get('cursor')
+    weather = args.get('weather', '').lower()
+    if weather not in WEATHER_FLAGS:
+        abort(400, 'Invalid weather, use 1 or 0.')
+    weather = WEATHER_FLAGS[weather]
+
+    unknown = [field for field in filter_list if field not in LIST_FIELDS]
+    if unknown:
+        abort(400, 'Unknown field ' + ', '.join(unknown) + '. Fields are ' + ', '.join(LIST_FIELDS) + '.')
+    order_keys = []
+    for order in order_list:
+        order_field = order[1:]
+        if order[:1] not in ('+', '-') or order_field not in ORDER_FIELDS:
+            abort(400, 'Invalid order ' + order + ', use +field or -field with one of ' + ', '.join(ORDER_FIELDS) + '.')
+        order_direction = desc if order[0] == '-' else asc
+        column = EventDB.start_time if order_field == 'datetime' else getattr(EventDB, order_field)
+        order_keys.append((column, order_direction))
+    # id breaks ties so that every ordering is total, which keyset pagination relies on
+    if all(column is not EventDB.id for column, _ in order_keys):
+        order_keys.append((EventDB.id, asc))
+    order_expressions = [order_direction(column) for column, order_direction in order_keys]
+
+    if cursor:
+        try:
+            cursor_values = decode_cursor(cursor, order_str, order_keys)
+        except ValueError:
+            abort(400, 'Invalid cursor, it does not belong to this ordering.')
+
+    calendar_id = calendar_arg(session, args)
+    columns = [getattr(EventDB, field) for field in filter_list]
+    columns += [column for column, _ in order_keys if column.key not in filter_list]
+    if weather:
+        # the forecast is looked up by place and start time, whether or not they are listed
+        selected = {column.key for column in columns}
+        columns += [getattr(EventDB, field) for field in ('suburb', 'state', 'start_time') if field not in selected]
+    events_query = session.query(*columns).filter(EventDB.calendar_id == calendar_id, *event_predicates(args)) \
+        .order_by(*order_expressions)
+    if cursor is None:
+        events_query = events_query.offset((page - 1) * size)
+    elif cursor:
+        events_query = events_query.filter(keyset_filter(order_keys, cursor_values))
+    # one extra row tells whether a next page exists without a second count query
+    events = events_query.limit(size + 1).all()
+    has_next = len(events) > size
+    events = events[:size]
+    return {
+        'events': events, 'has_next': has_next, 'page': page, 'size': size, 'cursor': cursor, 'weather': weather,
+        'order_str': order_str, 'order_keys': order_keys, 'filter_str': filter_str, 'filter_list': filter_list,
+        'predicate_args': {name: args[name] for name in PREDICATE_ARGS if name in args},
+    }
+
+# help function - the list response of a page, with each event's forecast when weather is given
+def event_page_response(page_query, weather=None):
+    events = page_query['events']
+    page, size, cursor, has_next = page_query['page'], page_query['size'], page_query['cursor'], page_query['has_next']
+    order_str, order_keys, filter_str = page_query['order_str'], page_query['order_keys'], page_query['filter_str']
+
+    result = []
+    for i, event in enumerate(events):
+        event_dict = {}
+        for condition in page_query['filter_list']:
+            event_dict[condition] = str(getattr(event, condition))
+        if weather is not None:
+            event_dict['_metadata'] = weather_metadata(weather[i])
+        result.append(event_dict)
+
+
+    query_string = f"order={order_str}&size={size}&filter={filter_str}"
+    predicate_args = dict(page_query['predicate_args'])
+    if page_query['weather']:
+        predicate_args['weather'] = 1
+    if predicate_args:
+        query_string += '&' + urlencode(predicate_args)
+
+    if cursor is None:
+        self_url = f"/events?{query_string}&page={page}"
+        next_url = f"/events?{query_string}&page={page + 1}" if has_next else "last page reached"
+    else:
+        next_cursor = encode_cursor(order_str, [getattr(events[-1], column.key) for column, _ in order_keys]) if has_next else None
+        self_url = f"/events?{query_string}&cursor={cursor}"
+        next_url = f"/events?{query_string}&cursor={next_cursor}" if has_next else "last page reached"
+
+    response = {"page": page} if cursor is None else {}
+    response.update({
+        "page-size": size,
+        "events": result,
+        "_links": {
+            "self": {
+                "href": self_url,
+            },
+            "next": {
+                "href": next_url
+            }
+        }
+    })
+    return response
+
+# help function - convert one bulk record (flat csv row or POST-shaped json object) into event columns
+def parse_bulk_record(record):
+    location = record.get('location') or record
+    try:
+        start_time = datetime.strptime(str(record['date']) + ' ' + str(record['from']), '%Y-%m-%d %H:%M:%S')
+        end_time = datetime.strptime(str(record['date']) + ' ' + str(record['to']), '%Y-%m-%d %H:%M:%S')
+    except KeyError as err:
+        raise ValueError('missing field ' + str(err))
+    except ValueError:
+        raise ValueError('Incorrect date or time format. Please use YYYY-MM-DD and HH:MM:SS, respectively.')
+    if start_time >= end_time:
+        raise ValueError('Invalid start or end time.')
+    # a POST-shaped recurrence object, or the flat rule and comma separated exceptions of an export
+    recurrence = record.get('recurrence')
+    if isinstance(recurrence, dict):
+        rule, exceptions = recurrence.get('rule'), recurrence.get('exceptions')
+    else:
+        rule, exceptions = recurrence, record.get('exceptions')
+    recurrence = None
+    if rule:
+        try:
+            recurrence = recurrence_of(rule, exceptions, start_time, end_time)
+        except ValueError as err:
+            raise ValueError('Invalid recurrence: ' + str(err))
+    try:
+        state = state_name_converter(str(location['state']))
+        return {
+            'name': str(record['name']),
+            'start_time': start_time,
+            'end_time': end_time,
+            'description': str(record.get('description')),
+            'street': str(location['street']),
+            'suburb': str(location['suburb']),
+            'state': state,
+            'post_code': str(location['post-code']),
+            'rrule': recurrence.rule if recurrence is not None else None,
+            'exdates': ','.join(recurrence.exceptions) if recurrence is not None else None,
+            'series_end': recurrence.last_end(start_time, end_time) if recurrence is not None else None
+        }
+    except KeyError as err:
+        raise ValueError('missing field ' + str(err))
+    except ValueError:
+        raise ValueError('Invalid state name, please use Australian states and territories')
+
+# help function - read the uploaded ndjson or csv stream line by line, yielding (line number, record)
+def read_bulk_stream(stream, content_type):
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if content_type == 'text/csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_number, line in enumerate(text, start=1):
+            if line.strip():
+                try:
+                    yield line_number, json.loads(line)
+                except json.JSONDecodeError:
+                    yield line_number, None
+
+# help function - recurrence of a parsed bulk row, None for a one-off event
+def bulk_recurrence(row):
+    return Recurrence.parse(row['rrule'], row['exdates']) if row['rrule'] else None
+
+# help function - overlaps inside a batch and against stored events, series occurrence by occurrence
+# the batch is indexed by line number and probed in start order, so an overlapping pair is reported once, on its later row
+def detect_bulk_overlapping(calendar_id, rows):
+    recurrences = {line_number: bulk_recurrence(row) for line_number, row in rows}
+    batch_index = IntervalIndex()
+    batch_index.load((line_number, row['start_time'], row['end_time'], recurrences[line_number]) for line_number, row in rows)
+    conflicts = []
+    probed = set()
+    for line_number, row in sorted(rows, key=lambda item: item[1]['start_time']):
+        recurrence = recurrences[line_number]
+        earlier = [line for line in index_overlapping(batch_index, row['start_time'], row['end_time'], line_number, recurrence)
+                   if line in probed]
+        if earlier:
+            conflicts.append({'line': line_number, 'message': 'overlaps line ' + str(min(earlier))})
+        stored = detect_overlapping(calendar_id, row['start_time'], row['end_time'], recurrence=recurrence)
+        if stored:
+            conflicts.append({'line': line_number, 'message': 'overlaps stored events', 'conflicts': stored})
+        probed.add(line_number)
+    return conflicts
+
+# help function - overlaps of a batch with the events committed in the database, read in one go for the time span
+# of the whole batch; run once the calendar is locked, as the in-process index misses commits of other processes
+@timed
+def stored_bulk_overlapping(session, calendar_id, rows):
+    if not rows:
+        return []
+    recurrences = [bulk_recurrence(row) for _, row in rows]
+    window_start = min(row['start_time'] for _, row in rows)
+    window_end = max(overlap_window_end(row['start_time'], row['end_time'], recurrence)
+                     for (_, row), recurrence in zip(rows, recurrences))
+    interval_index = stored_interval_index(session, calendar_id, window_start, window_end)
+    conflicts = []
+    for (line_number, row), recurrence in zip(rows, recurrences):
+        stored = index_overlapping(interval_index, row['start_time'], row['end_time'], recurrence=recurrence)
+        if stored:
+            conflicts.append({'line': line_number, 'message': 'overlaps stored events', 'conflicts': stored})
+    return conflicts
+
+# help function - insert rows with executemany a chunk at a time, all chunks in one transaction so that
+# nothing is stored when one of them is rejected
+def insert_events_in_chunks(session, rows, chunk_size=BULK_CHUNK_SIZE):
+    changes = []
+    try:
+        for offset in range(0, len(rows), chunk_size):
+            inserted = session.execute(
+                insert(EventDB).returning(EventDB.calendar_id, EventDB.id, EventDB.start_time, EventDB.end_time,
+                                          EventDB.rrule, EventDB.exdates),
+                rows[offset:offset + chunk_size])
+            changes.extend((calendar_id, event_id, start_time, end_time, Recurrence.parse(rrule, exdates) if rrule else None)
+                           for calendar_id, event_id, start_time, end_time, rrule, exdates in inserted)
+        # core inserts bypass the flush hooks, record the new intervals for the index by hand
+        session.info.setdefault('interval_changes', []).extend(changes)
+        session.commit()
+    except IntegrityError:
+        # an event written concurrently collides with the upload
+        session.rollback()
+        abort(409, 'Events overlapping detected while storing, nothing was stored.')
+    return len(rows)
+
+# help function - stream all events of a calendar ordered by start time through a server-side cursor
+# the stream outlives the view function, so it owns a session of its own
+def export_events(export_format, calendar_id=DEFAULT_CALENDAR_ID):
+    session = Session()
+    try:
+        result = session.execute(
+            select(EventDB.__table__).where(EventDB.calendar_id == calendar_id).order_by(EventDB.start_time)
+            .execution_options(stream_results=True))
+        if export_format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+        for rows in result.partitions(BULK_CHUNK_SIZE):
+            records = [{
+                'id': row.id,
+                'name': row.name,
+                'date': str(row.start_time.date()),
+                'from': str(row.start_time.time()),
+                'to': str(row.end_time.time()),
+                'street': row.street,
+                'suburb': row.suburb,
+                'state': row.state,
+                'post-code': row.post_code,
+                'description': row.description,
+                'recurrence': row.rrule,
+                'exceptions': row.exdates,
+                'last-update': str(row.last_updated)
+            } for row in rows]
+            if export_format == 'csv':
+                writer.writerows(records)
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            else:
+                yield ''.join(json.dumps(record) + '\n' for record in records)
+    finally:
+        session.close()
+
 def check_weekend(date_obj):
     is_weekend = False
     if date_obj.weekday() >= 5:
@@ -204,36 +1088,312 @@ def check_weekend(date_obj):
     
     return is_weekend
 
+# help function - window, duration, size, exclusions and state of GET /events/free-slots
+def free_slot_query(args):
+    try:
+        date_from = datetime.strptime(args['from'], '%Y-%m-%d').date() if 'from' in args else datetime.now().date()
+        date_to = datetime.strptime(args['to'], '%Y-%m-%d').date() if 'to' in args \
+            else date_from + timedelta(days=FREE_SLOT_DAYS - 1)
+        duration = int(args['duration'])
+        size = int(args.get('size', 10))
+    except KeyError:
+        abort(400, 'Please give the duration of the slot in minutes.')
+    except ValueError:
+        abort(400, 'Invalid query, please use YYYY-MM-DD for from and to and integers for duration and size.')
+    if not 0 < duration < 24 * 60:
+        abort(400, 'Invalid duration, events last between 1 minute and a day.')
+    if not 0 < size <= MAX_FREE_SLOTS:
+        abort(400, 'Invalid size, please ask for 1 to ' + str(MAX_FREE_SLOTS) + ' slots.')
+    if date_to < date_from or (date_to - date_from).days >= MAX_FREE_SLOT_DAYS:
+        abort(400, 'Invalid window, to must follow from by less than ' + str(MAX_FREE_SLOT_DAYS) + ' days.')
+    exclusions = [exclusion.strip() for exclusion in args.get('exclude', '').split(',') if exclusion.strip()]
+    unknown = [exclusion for exclusion in exclusions if exclusion not in FREE_SLOT_EXCLUSIONS]
+    if unknown:
+        abort(400, 'Unknown exclusion ' + ', '.join(unknown) + '. Exclusions are ' + ', '.join(FREE_SLOT_EXCLUSIONS) + '.')
+    state = None
+    if 'state' in args:
+        try:
+            state = state_name_converter(args['state'])
+        except ValueError:
+            abort(400, 'Invalid state name, please use Australian states and territories')
+    return date_from, date_to, timedelta(minutes=duration), size, exclusions, state
+
+# help function - (first, last) bookable instants of the first `size` free ranges of at least `duration`,
+# found in one sweep over the busy intervals ordered by start, a day at a time as events never span midnight
+@timed
+def find_free_slots(busy, date_from, date_to, duration, size, skip_day=None):
+    slots = []
+    first = 0
+    day = date_from
+    while day <= date_to and len(slots) < size:
+        day_start = datetime(day.year, day.month, day.day)
+        day_end = day_start + timedelta(days=1) - BOOKING_RESOLUTION
+        if skip_day is not None and skip_day(day):
+            day += timedelta(days=1)
+            continue
+        # intervals over before this day are never looked at again
+        while first < len(busy) and busy[first][1] < day_start:
+            first += 1
+        free_from = day_start
+        position = first
+        while len(slots) < size:
+            if position < len(busy) and busy[position][0] <= day_end:
+                free_until = busy[position][0] - BOOKING_RESOLUTION
+                next_free = busy[position][1] + BOOKING_RESOLUTION
+            else:
+                free_until, next_free = day_end, None
+            if free_until - free_from >= duration:
+                slots.append((free_from, free_until))
+            if next_free is None or next_free > day_end:
+                break
+            # a short interval inside a longer one must not move the free range back
+            free_from = max(free_from, next_free)
+            position += 1
+        day += timedelta(days=1)
+    return slots
+
+# help function - GET /events/free-slots response
+def free_slots_response(calendar_id, date_from, date_to, duration, slots):
+    return {
+        'calendar': calendar_id,
+        'from': str(date_from),
+        'to': str(date_to),
+        'duration': int(duration.total_seconds() // 60),
+        'slots': [{
+            'date': str(free_from.date()),
+            'from': str(free_from.time()),
+            'to': str(free_until.time()),
+            'free-minutes': int((free_until - free_from).total_seconds() // 60),
+        } for free_from, free_until in slots],
+        '_links': {
+            'events': {
+                'href': '/events?' + urlencode({'calendar': calendar_id, 'from': str(date_from), 'to': str(date_to)})
+            }
+        }
+    }
+
+# help function - number of events starting on each day, counted by the database in one GROUP BY
+# recurring events add their occurrences in the window, endless rules up to RECURRENCE_HORIZON ahead
+@timed
+def count_events_per_day(session, calendar_id, date_from=None, date_to=None):
+    day = func.date(EventDB.start_time)
+    query = session.query(day, func.count(EventDB.id)).filter(EventDB.calendar_id == calendar_id, EventDB.rrule.is_(None))
+    series = session.query(EventDB.start_time, EventDB.end_time, EventDB.rrule, EventDB.exdates) \
+        .filter(EventDB.calendar_id == calendar_id, EventDB.rrule.isnot(None))
+    if date_from is not None:
+        query = query.filter(EventDB.start_time >= date_from)
+        series = series.filter(or_(EventDB.series_end.is_(None), EventDB.series_end >= date_from))
+    if date_to is not None:
+        query = query.filter(EventDB.start_time < date_to + timedelta(days=1))
+        series = series.filter(EventDB.start_time < date_to + timedelta(days=1))
+    per_days = {str(date): count for date, count in query.group_by(day)}
+
+    window_end = date_to + timedelta(days=1, microseconds=-1) if date_to is not None else datetime.now() + RECURRENCE_HORIZON
+    for start_time, end_time, rrule, exdates in series:
+        for occurrence_start, _ in Recurrence.parse(rrule, exdates).occurrences(start_time, end_time, date_from, window_end):
+            # an occurrence that started before the window only reaches into it
+            if date_from is None or occurrence_start >= date_from:
+                date = str(occurrence_start.date())
+                per_days[date] = per_days.get(date, 0) + 1
+    return dict(sorted(per_days.items()))
+
 # help function -  draw image for summary of event frequency
+# a Figure per call on the Agg canvas, so rendering is thread-safe and never touches pyplot's global state
+@timed
 def image_constructor(total=0, total_current_week=0, total_current_month=0, per_days={}):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
     dates = []
     numbers_by_dates = []
     for k,v in per_days.items():
         dates.append(k)
         numbers_by_dates.append(v)
-    plt.clf()
-    plt.bar(dates, numbers_by_dates,width=0.2)
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.bar(dates, numbers_by_dates,width=0.2)
     
-    plt.title('Events numbers')
-    plt.xlabel('Date')
-    plt.ylabel('Number of events')
+    ax.set_title('Events numbers')
+    ax.set_xlabel('Date')
+    ax.set_ylabel('Number of events')
     
     yheight = max(numbers_by_dates)+1 if numbers_by_dates != [] else 1
-    plt.yticks(range(0, yheight, 1))
+    ax.set_yticks(range(0, yheight, 1))
     total_text = 'total: '+ str(total)
     
-    plt.text(0.1, -0.2, total_text, ha='center', va='center', transform=plt.gca().transAxes)
-    plt.text(0.35, -0.2, 'total-current-week: '+str(total_current_week), ha='center', va='center', transform=plt.gca().transAxes)
-    plt.text(0.75, -0.2, 'total-current-month: '+str(total_current_month), ha='center', va='center', transform=plt.gca().transAxes)
-    plt.subplots_adjust(bottom=0.3)
+    ax.text(0.1, -0.2, total_text, ha='center', va='center', transform=ax.transAxes)
+    ax.text(0.35, -0.2, 'total-current-week: '+str(total_current_week), ha='center', va='center', transform=ax.transAxes)
+    ax.text(0.75, -0.2, 'total-current-month: '+str(total_current_month), ha='center', va='center', transform=ax.transAxes)
+    fig.subplots_adjust(bottom=0.3)
     
     # convert image into bytes
     img = io.BytesIO()
-    plt.savefig(img, format='png')
+    fig.savefig(img, format='png')
     img.seek(0)
     
     return img
 
+# help function - per day, current week and current month event counts of a calendar for the optional from and to
+# query arguments, cached per calendar until the next commit touching that calendar in this process,
+# and for at most RESPONSE_CACHE_TTL seconds as commits of other processes are not seen
+@timed
+def event_statistics(session, args):
+    calendar_id = calendar_arg(session, args)
+    try:
+        date_from = datetime.strptime(args['from'], '%Y-%m-%d') if 'from' in args else None
+        date_to = datetime.strptime(args['to'], '%Y-%m-%d') if 'to' in args else None
+    except ValueError:
+        abort(400, 'Incorrect date format. Please use YYYY-MM-DD for from and to.')
+    today = datetime.now().date()
+    key = (calendar_id, calendar_versions.get(calendar_id, 0), date_from, date_to, today)
+    with statistics_cache_lock:
+        entry = statistics_cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < RESPONSE_CACHE_TTL:
+            statistics_cache.move_to_end(key)
+            return entry[1]
+    
+    per_days = count_events_per_day(session, calendar_id, date_from, date_to)
+    current_week = today.isocalendar()[:2]
+    total = sum(per_days.values())
+    total_current_week = 0
+    total_current_month = 0
+    for date_str, count in per_days.items():
+        day = datetime.strptime(date_str, '%Y-%m-%d').date()
+        if day.isocalendar()[:2] == current_week:
+            total_current_week += count
+        if (day.year, day.month) == (today.year, today.month):
+            total_current_month += count
+            
+    statistics = {
+        'total': total,
+        'total-current-week': total_current_week,
+        'total-current-month': total_current_month,
+        'per-days': per_days
+    }
+    with statistics_cache_lock:
+        statistics_cache[key] = (time.monotonic(), statistics)
+        while len(statistics_cache) > STATISTICS_CACHE_SIZE:
+            statistics_cache.popitem(last=False)
+    return statistics
+
+# help function - version of a json payload, identical payloads give the same version
+def payload_version(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+# help function - rendered chart for a statistics version, rendering only on a cache miss
+def cached_chart(version, statistics):
+    with chart_cache_lock:
+        png = chart_cache.get(version)
+        if png is not None:
+            chart_cache.move_to_end(version)
+            return png
+    png = image_constructor(statistics['total'], statistics['total-current-week'],
+                            statistics['total-current-month'], statistics['per-days']).getvalue()
+    with chart_cache_lock:
+        chart_cache[version] = png
+        while len(chart_cache) > CHART_CACHE_SIZE:
+            chart_cache.popitem(last=False)
+    return png
+
+# help function - cache key of an event body, a change to the row or to its neighbours gives a new key
+def event_response_key(event, previous_id, next_id):
+    return (event.calendar_id, 'event', event.id, event.version, previous_id, next_id)
+
+# help function - cache key of a list page, valid until the next commit touching the calendar
+def page_response_key(calendar_id, args):
+    return (calendar_id, 'page', calendar_versions.get(calendar_id, 0),
+            tuple(sorted((name, tuple(args.getlist(name))) for name in args.keys())))
+
+# help function - cached (body, etag) of a response key, None when missing or older than RESPONSE_CACHE_TTL
+def lookup_response(key):
+    with response_cache_lock:
+        entry = response_cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= RESPONSE_CACHE_TTL:
+            del response_cache[key]
+            return None
+        response_cache.move_to_end(key)
+        return entry[1], entry[2]
+
+# help function - cache a rendered body, its etag is the version of the body after the optional prefix;
+# a body that is not final only gets its etag
+def store_response(key, body, etag_prefix='', final=True):
+    etag = etag_prefix + payload_version(body)
+    if not final:
+        return body, etag
+    with response_cache_lock:
+        response_cache[key] = (time.monotonic(), body, etag)
+        while len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+    return body, etag
+
+# help function - drop the cached responses of a calendar
+def invalidate_responses(calendar_id):
+    with response_cache_lock:
+        for key in [key for key in response_cache if key[0] == calendar_id]:
+            del response_cache[key]
+
+# help function - ETag and Last-Modified headers of an event response
+def event_validators(event, etag):
+    headers = {'ETag': '"' + etag + '"'}
+    if event.last_updated is not None:
+        headers['Last-Modified'] = http_date(event.last_updated.astimezone(timezone.utc))
+    return headers
+
+# help function - forecast date and {city: (lat, lon)} for the date and cities query arguments
+def weather_query(args):
+    now = datetime.now()
+    default_date = now.strftime('%d-%m-%Y')
+    try:
+        date_query = args.get('date', default_date)
+        date_obj = datetime.strptime(date_query, '%d-%m-%Y')
+        date = date_obj.strftime('%Y%m%d')
+    except:
+        abort(400, 'Invalid input, query date format should be  DD-MM-YYYY.')
+        
+    cities_query = args.get('cities')
+    cities_list = [city.strip() for city in cities_query.split(',')] if cities_query else geodata.capitals
+    geo_dict = {}
+    for city in cities_list:
+        place = geodata.cities.lookup(city)
+        if place is None:
+            abort(400, 'Unknown city: ' + city)
+        geo_dict.update({city: place})
+    return date, geo_dict
+
+# help function - weather of each city on date, from the civillight forecasts in geo_dict order
+def weather_report(date, geo_dict, forecasts):
+    weather_dict = {}
+    for (city, (lat, lon)), res in zip(geo_dict.items(), forecasts):
+        weather = "*no forecast made*"
+        if res is not None:
+            for forecast in res['dataseries']:
+                if str(forecast['date']) == str(date):
+                    weather = forecast['weather']
+        weather_dict.update({city: {'weather': weather, 'latitude': lat, 'longitude' : lon}})
+    return weather_dict
+
+# help function - json representation of a calendar with the links to its events
+def calendar_response(calendar_row):
+    return {
+        'id': calendar_row.id,
+        'name': calendar_row.name,
+        'owner': calendar_row.owner,
+        '_links': {
+            'self': {
+                'href': '/calendars/' + str(calendar_row.id)
+            },
+            'events': {
+                'href': '/events?calendar=' + str(calendar_row.id)
+            },
+            'statistics': {
+                'href': '/events/statistics?calendar=' + str(calendar_row.id)
+            }
+        }
+    }
+
 # APIs starts here!
 @api.route('/events')
 class Events(Resource):
@@ -242,6 +1402,8 @@ class Events(Resource):
     @api.response(201, 'Event created successfully', model=event)
     @api.response(400, 'Invalid input')
     @api.response(409, 'Events are overlapped')
+    @api.response(503, 'Database busy, retry later')
+    @api.doc(params={'calendar': {'description':'calendar id, the default calendar when omitted','type': 'int', 'required': False}})
     def post(self):
         event_parser = reqparse.RequestParser()
         event_parser.add_argument('name', type=str, help='Name of the event', required=True)
@@ -250,6 +1412,7 @@ class Events(Resource):
         event_parser.add_argument('to', type=str, help='End time of the event (HH:MM:SS)', required=True)
         event_parser.add_argument('location', type=dict, help='Location of the event', required=True)
         event_parser.add_argument('description', type=str, help='Description of the event')
+        event_parser.add_argument('recurrence', type=dict, help='Recurrence rule and excluded dates of the event', required=False)
 
         args = event_parser.parse_args()
 
@@ -259,9 +1422,15 @@ class Events(Resource):
             end_time = datetime.strptime(args['date'] + ' ' + args['to'], '%Y-%m-%d %H:%M:%S')
         except ValueError:
             abort(400, 'Incorrect date or time format. Please use YYYY-MM-DD and HH:MM:SS, respectively.')
+        if start_time >= end_time:
+            abort(400, 'Invalid start or end time.')
+        recurrence = parse_recurrence(args['recurrence'], start_time, end_time)
+        session = db_session()
+        calendar_id = calendar_arg(session, request.args)
             
-        if detect_overlapping(start_time, end_time):
-            abort(409, 'Events overlapping detected.')
+        conflicts = detect_overlapping(calendar_id, start_time, end_time, recurrence=recurrence)
+        if conflicts:
+            abort(409, 'Events overlapping detected.', conflicts=conflicts)
             
         try:
             state = str(args['location']['state'])
@@ -270,24 +1439,32 @@ class Events(Resource):
             abort(400, 'Invalid state name, please use Australian states and territories')
 
 
-        # Create a new event and commit to DB
-        new_event = EventDB(
-            name=str(args['name']),
-            start_time=start_time,
-            end_time=end_time,
-            description=str(args['description']),
-            street=str(args['location']['street']),
-            suburb=str(args['location']['suburb']),
-            state=state,
-            post_code=str(args['location']['post-code']))
-
-        session = Session()
-        session.add(new_event)
-        session.commit()
+        # Create a new event and commit to DB, checked again against the database while the calendar is locked
+        def write():
+            lock_calendar(session, calendar_id)
+            conflicts = stored_overlapping(session, calendar_id, start_time, end_time, recurrence=recurrence)
+            if conflicts:
+                abort(409, 'Events overlapping detected.', conflicts=conflicts)
+            new_event = EventDB(
+                name=str(args['name']),
+                start_time=start_time,
+                end_time=end_time,
+                description=str(args['description']),
+                street=str(args['location']['street']),
+                suburb=str(args['location']['suburb']),
+                state=state,
+                post_code=str(args['location']['post-code']),
+                recurrence=recurrence,
+                calendar_id=calendar_id)
+            session.add(new_event)
+            commit_or_conflict(session, calendar_id, start_time, end_time)
+            return new_event
+        new_event = retry_on_conflict(session, write)
 
         # json response
         response = {
             'id': new_event.id,
+            'version': new_event.version,
             'last-update': str(new_event.last_updated),
             '_links': {
                 'self': {
@@ -304,155 +1481,194 @@ class Events(Resource):
     @api.doc(params={'page': {'description':'page to be checked: integer','type': 'int', 'required': False}})
     @api.doc(params={'size': {'description':'events number per page: integer','type': 'int', 'required': False}})
     @api.doc(params={'filter': {'description':'query filter gievn by csv formatted value: e.g. id,name,start_time,description','required': False}})
+    @api.doc(params={'cursor': {'description':'opt-in keyset pagination: pass an empty cursor for the first page, then follow the next link','required': False}})
+    @api.doc(params={'from': {'description':'events starting on or after this date, YYYY-MM-DD','required': False}})
+    @api.doc(params={'to': {'description':'events starting on or before this date, YYYY-MM-DD','required': False}})
+    @api.doc(params={'state': {'description':'events in this state or territory, e.g. NSW','required': False}})
+    @api.doc(params={'suburb': {'description':'events in this suburb, case insensitive','required': False}})
+    @api.doc(params={'name': {'description':'events whose name starts with this prefix, case insensitive','required': False}})
+    @api.doc(params={'q': {'description':'events whose description contains all of these words','required': False}})
+    @api.doc(params={'calendar': {'description':'calendar id, the default calendar when omitted','type': 'int', 'required': False}})
+    @api.doc(params={'weather': {'description':'1 to add the forecast of each event, one 7timer request per grid cell','required': False}})
+    @api.response(304, 'Events not modified')
     def get(self):
-        session = Session()
-        try:
-            order_str = request.args.get('order', '+id').replace(' ', '+')
-            order_set = set(order_str.split(','))
-            page = int(request.args.get('page', 1))
-            size = int(request.args.get('size', 10))
-            filter_str = request.args.get('filter', 'id,name')
-            filter_set = set(filter_str.split(','))
-        except ValueError:
-            abort(400, 'Invalid query, please use order, page, size and filter only.')
+        session = db_session()
+        key = page_response_key(calendar_arg(session, request.args), request.args)
+        cached = lookup_response(key)
+        if cached is None:
+            body, weather = list_events(session, request.args)
+            cached = store_response(key, body, final=weather_final(weather))
+        body, etag = cached
+        headers = {'ETag': '"' + etag + '"'}
+        if request.if_none_match.contains(etag):
+            return None, 304, headers
+        return body, 200, headers
+    
 
+# GET the forecasts of several events at once
+@api.route('/events/weather')
+class EventsWeather(Resource):
+    @api.response(200, 'Weather retrieved successfully')
+    @api.response(400, 'Invalid input')
+    @api.doc(params={'ids': {'description':'comma separated event ids, at most 100','required': True}})
+    def get(self):
+        event_ids = weather_ids(request.args)
+        events = db_session().query(EventDB).filter(EventDB.id.in_(event_ids)).all()
+        return events_weather_response(event_ids, events, batch_weather(events)), 200
 
-        try:
-            order_expressions = []
-            for order in order_set:
-                order_direction = desc if order[0] == '-' else asc
-    
-                order_field = order[1:]
-                if order_field == 'datetime':
-                    column = getattr(EventDB, 'start_time', None)
-                else:
-                    column = getattr(EventDB, order_field, None)
-                order_expressions.append(order_direction(column))
-                
-            if order_expressions == []:
-                order_expressions = [asc(EventDB.id)]
-     
-            events_query = session.query(EventDB).order_by(*order_expressions)
-            events = events_query.limit(size).offset((page - 1) * size).all()
-            following_items = events_query.offset(page * size).count()
-            has_next = True if following_items > 0 else False
-    
+
+# GET free time of a calendar
+@api.route('/events/free-slots')
+class EventsFreeSlots(Resource):
+    @api.response(200, 'Free slots retrieved successfully')
+    @api.response(400, 'Invalid input')
+    @api.response(404, 'Calendar not found')
+    @api.doc(description='Free ranges long enough for an event of the given duration, earliest first. from and to are '
+             'the first and last bookable times of a range, events must not touch each other.')
+    @api.doc(params={'duration': {'description':'length of the event in minutes','type': 'int', 'required': True}})
+    @api.doc(params={'from': {'description':'first day searched, YYYY-MM-DD, today when omitted','required': False}})
+    @api.doc(params={'to': {'description':'last day searched, YYYY-MM-DD, two weeks from the first day when omitted','required': False}})
+    @api.doc(params={'size': {'description':'most slots returned, at most 100','type': 'int', 'required': False}})
+    @api.doc(params={'exclude': {'description':'csv of days to skip: weekends, holidays','required': False}})
+    @api.doc(params={'state': {'description':'state whose public holidays are skipped, national holidays only when omitted','required': False}})
+    @api.doc(params={'calendar': {'description':'calendar id, the default calendar when omitted','type': 'int', 'required': False}})
+    def get(self):
+        date_from, date_to, duration, size, exclusions, state = free_slot_query(request.args)
+        session = db_session()
+        calendar_id = calendar_arg(session, request.args)
+        window_start = datetime(date_from.year, date_from.month, date_from.day)
+        window_end = datetime(date_to.year, date_to.month, date_to.day) + timedelta(days=1) - BOOKING_RESOLUTION
+        # read from the database, the in-process index misses events written by other processes
+        busy = stored_interval_index(session, calendar_id, window_start, window_end).intervals(window_start, window_end)
+
+        def skip_day(day):
+            return ('weekends' in exclusions and check_weekend(day)) or \
+                ('holidays' in exclusions and holiday_provider.lookup(day, state) is not None)
+
+        slots = find_free_slots(busy, date_from, date_to, duration, size, skip_day if exclusions else None)
+        return free_slots_response(calendar_id, date_from, date_to, duration, slots), 200
     
-            result = []
-            for event in events:
-                event_dict = {}
-                for condition in filter_set:
-                    event_dict[condition] = str(getattr(event, condition))
-                result.append(event_dict)
-        
-        except:
-            abort(400, 'Invalid query, inappropriate formatted value or the field requested does not exist.')
 
+# POST many events at once, GET all events as a stream
+@api.route('/events/bulk')
+class EventsBulk(Resource):
+    @api.doc(description='Upload events as application/x-ndjson (one POST body per line) or text/csv with the columns '
+             'name,date,from,to,street,suburb,state,post-code,description and optionally recurrence (the rule) and exceptions '
+             '(comma separated dates), as written by /events/export. Nothing is stored if any line is rejected.')
+    @api.response(201, 'Events created successfully')
+    @api.response(400, 'Invalid input')
+    @api.response(409, 'Events are overlapped')
+    @api.response(415, 'Unsupported content type')
+    @api.response(503, 'Database busy, retry later')
+    @api.doc(params={'calendar': {'description':'calendar id, the default calendar when omitted','type': 'int', 'required': False}})
+    def post(self):
+        content_type = request.mimetype
+        if content_type not in ('application/x-ndjson', 'application/json', 'text/csv'):
+            abort(415, 'Please upload application/x-ndjson or text/csv.')
 
-        query_string = f"order={order_str}&size={size}&filter={filter_str}"
+        session = db_session()
+        calendar_id = calendar_arg(session, request.args)
+        rows = []
+        errors = []
+        for line_number, record in read_bulk_stream(request.stream, content_type):
+            try:
+                if not isinstance(record, dict):
+                    raise ValueError('line is not a json object')
+                rows.append((line_number, parse_bulk_record(record)))
+            except ValueError as err:
+                errors.append({'line': line_number, 'message': str(err)})
+                if len(errors) >= BULK_MAX_ERRORS:
+                    break
+        if errors:
+            abort(400, 'Invalid events in upload, nothing was stored.', errors=errors)
 
-        self_url = f"/events?{query_string}&page={page}r"
-        next_url = f"/events?{query_string}&page={page + 1}" if has_next else "last page reached"
+        conflicts = detect_bulk_overlapping(calendar_id, rows)
+        if conflicts:
+            abort(409, 'Events overlapping detected, nothing was stored.', errors=conflicts[:BULK_MAX_ERRORS])
 
+        # checked again against the database while the calendar is locked, then stored in the same transaction
+        def write():
+            lock_calendar(session, calendar_id)
+            conflicts = stored_bulk_overlapping(session, calendar_id, rows)
+            if conflicts:
+                abort(409, 'Events overlapping detected, nothing was stored.', errors=conflicts[:BULK_MAX_ERRORS])
+            return insert_events_in_chunks(session, [dict(row, calendar_id=calendar_id) for _, row in rows])
+        created = retry_on_conflict(session, write)
         response = {
-            "page": page,
-            "page-size": size,
-            "events": result,
-            "_links": {
-                "self": {
-                    "href": self_url,
-                },
-                "next": {
-                    "href": next_url
+            'created': created,
+            '_links': {
+                'events': {
+                    'href': '/events?calendar=' + str(calendar_id)
                 }
             }
         }
-        return response, 200
-    
+        return response, 201
+
+@api.route('/events/export')
+class EventsExport(Resource):
+    @api.response(200, 'Events exported successfully')
+    @api.response(400, 'Invalid request')
+    @api.doc(params={'format': 'The export format can be requested: ndjson, csv'})
+    @api.doc(params={'calendar': {'description':'calendar id, the default calendar when omitted','type': 'int', 'required': False}})
+    def get(self):
+        export_format = request.args.get('format', 'ndjson')
+        if export_format == 'csv':
+            mimetype = 'text/csv'
+        elif export_format == 'ndjson':
+            mimetype = 'application/x-ndjson'
+        else:
+            abort(400, 'format not supported. Please use ndjson or csv.')
+        calendar_id = calendar_arg(db_session(), request.args)
+        return Response(stream_with_context(export_events(export_format, calendar_id)), mimetype=mimetype)
+
 
 @api.route('/events/<int:event_id>')
 class Event(Resource):
 # GET an event
     @api.response(200, 'Event retrieved successfully', model=event)
+    @api.response(304, 'Event not modified')
     @api.response(404, 'Event not found')
     def get(self, event_id):
         # Find the event by its ID
-        session = Session()
-        event = session.query(EventDB).filter_by(id=event_id).first()
+        session = db_session()
+        event, previous_id, next_id = find_adjacency(session, event_id)
 
         if event is None:
             abort(404, 'Event not found')
-        
-        try:
-            weather_info = weatherAPI(event_id)
-            wind_speed = weather_info['wind10m']['speed']
-            weather = weather_info['weather']
-            humidity = weather_info['rh2m']
-            temperature = weather_info['temp2m']
-        except:
-            index_error_msg = "*not available*"
-            wind_speed = index_error_msg
-            weather = index_error_msg
-            humidity = index_error_msg
-            temperature = index_error_msg
-            
-        holiday_name = holidayAPI(event_id)
-        
-        
-        prev_event, next_event = find_adjacency(event)
-        prev_url = '/events/' + str(prev_event.id) if prev_event is not None else 'no existing event'
-        next_url = '/events/' + str(next_event.id) if next_event is not None else 'no existing event'
 
-        event_response = {
-            'id': event.id,
-            'name': event.name,
-            'date': str(event.start_time.date()),
-            'from': str(event.start_time.time()),
-            'to': str(event.end_time.time()),
-            'location': {
-                'street': event.street,
-                'suburb': event.suburb,
-                'state': event.state,
-                'post-code': event.post_code
-                },
-            'description': event.description,
-            'last-update': str(event.last_updated),
-            "_metadata" : {
-                  "wind-speed": str(wind_speed) + " KM", 
-                  "weather": weather,
-                  "humidity": humidity,
-                  "temperature": str(temperature) + " C",
-                  "holiday": holiday_name,
-                  "weekend": check_weekend(event.start_time)
-                },
-            '_links': {
-                'self': {
-                    'href': '/events/' + str(event.id)
-                },
-                'previous': {
-                    'href': prev_url
-                },
-                'next': {
-                    'href': next_url
-                }
-            }
-        }
-
-        return event_response, 200
+        # the etag starts with the row version, the forecast and holiday are only looked up on a cache miss
+        key = event_response_key(event, previous_id, next_id)
+        cached = lookup_response(key)
+        if cached is None:
+            weather_info = weatherAPI(event)
+            cached = store_response(key, event_detail(event, previous_id, next_id, weather_info, holidayAPI(event)),
+                                    str(event.version) + '-', weather_final([weather_info]))
+        body, etag = cached
+        headers = event_validators(event, etag)
+        if request.if_none_match.contains(etag):
+            return None, 304, headers
+        return body, 200, headers
     
 # DELETE an event
     @api.response(200, 'Event deleted successfully')
     @api.response(404, 'Event not found')
+    @api.response(412, 'Event changed since the If-Match version')
+    @api.doc(params={'If-Match': {'in': 'header', 'description': 'etag or version the event must still have', 'required': False}})
     def delete(self, event_id):
-        # Find the event by ID
-        session = Session()
-        event = session.query(EventDB).filter_by(id=event_id).first()
-        if event is None:
-            abort(404, 'Event not found')
+        session = db_session()
 
-        # Remove the event from the list of events
-        session.delete(event)
-        session.commit()
+        def write():
+            # Find the event by ID
+            event = lock_event(session, event_id)
+            if event is None:
+                abort(404, 'Event not found')
+            if request.if_match and not version_matches(request.if_match, event.version):
+                abort(412, 'The event was changed, its version is now ' + str(event.version) + '.')
+
+            # Remove the event from the list of events
+            session.delete(event)
+            session.commit()
+        retry_on_conflict(session, write)
         delete_response = {
             "message": "Event " + str(event_id) + " has been removed!",
             'id': event_id
@@ -464,13 +1680,11 @@ class Event(Resource):
     @api.response(200, 'Event upodated successfully')
     @api.response(400, 'Invalid input')
     @api.response(404, 'Event not found')
+    @api.response(409, 'Events are overlapped')
+    @api.response(412, 'Event changed since the If-Match version')
+    @api.response(503, 'Database busy, retry later')
+    @api.doc(params={'If-Match': {'in': 'header', 'description': 'etag or version the event must still have', 'required': False}})
     def patch(self, event_id):
-        # Find the event by its ID
-        session = Session()
-        event = session.query(EventDB).filter_by(id=event_id).first()
-        if event is None:
-            abort(404, 'Event not found')
-        
         event_parser = reqparse.RequestParser()
         event_parser.add_argument('name', type=str, help='Name of the event', required=False)
         event_parser.add_argument('date', type=str, help='Date of the event (YYYY-MM-DD)', required=False)
@@ -478,53 +1692,72 @@ class Event(Resource):
         event_parser.add_argument('to', type=str, help='End time of the event (HH:MM:SS)', required=False)
         event_parser.add_argument('location', type=dict, help='Location of the event', required=False)
         event_parser.add_argument('description', type=str, help='Description of the event')
+        event_parser.add_argument('recurrence', type=dict, help='Recurrence rule and excluded dates, an empty rule makes the event one-off', required=False)
 
         args = event_parser.parse_args()
-        
-        # Validate and convert the date and time format
-        if args['date'] is None:
-            args['date'] = event.start_time.strftime('%Y-%m-%d')
-        if args['from'] is not None:
-            try:
-                start_time = datetime.strptime(args['date'] + ' ' + args['from'], '%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                abort(400, 'Incorrect date or time format. Please use YYYY-MM-DD and HH:MM:SS, respectively.')
-        else:
-            start_time = None
-            
-        if args['to'] is not None:
-            try:
-                end_time = datetime.strptime(args['date'] + ' ' + args['to'], '%Y-%m-%d %H:%M:%S')
-            except ValueError:
-                abort(400, 'Incorrect date or time format. Please use YYYY-MM-DD and HH:MM:SS, respectively.')
-        else:
-            end_time = None
-                
-        
-        if args['name'] is not None:
-            event.name=str(args['name'])
-        if start_time is not None:
-            event.start_time=start_time
-        if end_time is not None:
-            event.end_time=end_time
-        if args['description'] is not None:
-            event.description=str(args['description'])
-        if args['location'] is not None:
-            event.street=str(args['location']['street'])
-            event.suburb=str(args['location']['suburb'])
-            event.state=str(args['location']['state'])
-            event.post_code=str(args['location']['post-code'])
-            
-        event.last_updated = datetime.now() 
-        
-        if event.start_time >= event.end_time:
-            abort(400, 'Invalid start or end time.')
-        if detect_overlapping_patch(event, event.start_time, event.end_time):
-            abort(409, 'Events overlapping detected.')
-            
-        
+        session = db_session()
+
+        # read, check and update the event in one transaction with its calendar locked
+        def write():
+            # Find the event by its ID
+            event = lock_event(session, event_id)
+            if event is None:
+                abort(404, 'Event not found')
+            if request.if_match and not version_matches(request.if_match, event.version):
+                abort(412, 'The event was changed, its version is now ' + str(event.version) + '.')
+
+            # Validate and convert the date and time format
+            date = args['date'] if args['date'] is not None else event.start_time.strftime('%Y-%m-%d')
+            if args['from'] is not None:
+                try:
+                    start_time = datetime.strptime(date + ' ' + args['from'], '%Y-%m-%d %H:%M:%S')
+                except ValueError:
+                    abort(400, 'Incorrect date or time format. Please use YYYY-MM-DD and HH:MM:SS, respectively.')
+            else:
+                start_time = None
+
+            if args['to'] is not None:
+                try:
+                    end_time = datetime.strptime(date + ' ' + args['to'], '%Y-%m-%d %H:%M:%S')
+                except ValueError:
+                    abort(400, 'Incorrect date or time format. Please use YYYY-MM-DD and HH:MM:SS, respectively.')
+            else:
+                end_time = None
+
+            if args['name'] is not None:
+                event.name=str(args['name'])
+            if start_time is not None:
+                event.start_time=start_time
+            if end_time is not None:
+                event.end_time=end_time
+            if args['description'] is not None:
+                event.description=str(args['description'])
+            if args['location'] is not None:
+                event.street=str(args['location']['street'])
+                event.suburb=str(args['location']['suburb'])
+                event.state=str(args['location']['state'])
+                event.post_code=str(args['location']['post-code'])
+
+            if event.start_time >= event.end_time:
+                abort(400, 'Invalid start or end time.')
+            start_time, end_time = event.start_time, event.end_time
+            # the last occurrence moves with the first, so the rule is stored again even when unchanged
+            if args['recurrence'] is not None:
+                event.set_recurrence(parse_recurrence(args['recurrence'], start_time, end_time))
+            else:
+                event.set_recurrence(event.recurrence)
+            conflicts = detect_overlapping_patch(event, start_time, end_time) or \
+                stored_overlapping(session, event.calendar_id, start_time, end_time, event_id, event.recurrence)
+            if conflicts:
+                abort(409, 'Events overlapping detected.', conflicts=conflicts)
+            # last_updated and version are set by the update
+            commit_or_conflict(session, event.calendar_id, start_time, end_time, event_id)
+            return event
+        event = retry_on_conflict(session, write)
+
         patch_response = {
             'id': event_id,
+            'version': event.version,
             'last-update': str(event.last_updated),
             '_links': {
                 'self': {
@@ -532,8 +1765,66 @@ class Event(Resource):
                 }
             }  
         }
-        session.commit()
         return patch_response, 200
+
+# GET the occurrences of an event within a window, expanded lazily from its recurrence rule
+@api.route('/events/<int:event_id>/occurrences')
+class EventOccurrences(Resource):
+    @api.response(200, 'Occurrences retrieved successfully')
+    @api.response(400, 'Invalid input')
+    @api.response(404, 'Event not found')
+    @api.doc(params={'from': 'first date of the window, YYYY-MM-DD (optional)'})
+    @api.doc(params={'to': 'last date of the window, YYYY-MM-DD (optional)'})
+    @api.doc(params={'size': {'description': 'occurrences per page: integer', 'type': 'int', 'required': False}})
+    def get(self, event_id):
+        session = db_session()
+        event = session.query(EventDB).filter_by(id=event_id).first()
+        if event is None:
+            abort(404, 'Event not found')
+        try:
+            date_from = datetime.strptime(request.args['from'], '%Y-%m-%d') if 'from' in request.args else None
+            date_to = datetime.strptime(request.args['to'], '%Y-%m-%d') + timedelta(days=1, microseconds=-1) \
+                if 'to' in request.args else None
+            size = int(request.args.get('size', 10))
+        except ValueError:
+            abort(400, 'Invalid query, please use YYYY-MM-DD for from and to and an integer size.')
+        if size < 1:
+            abort(400, 'size must be positive.')
+
+        recurrence = event.recurrence
+        if recurrence is None:
+            occurrences = iter([(event.start_time, event.end_time)])
+            if (date_from is not None and event.end_time < date_from) or (date_to is not None and event.start_time > date_to):
+                occurrences = iter([])
+        else:
+            occurrences = recurrence.occurrences(event.start_time, event.end_time, date_from, date_to)
+        # one extra occurrence tells whether there is a next page
+        page = list(islice(occurrences, size + 1))
+        has_next = len(page) > size
+        page = page[:size]
+
+        query_string = f"size={size}" + (f"&to={request.args['to']}" if 'to' in request.args else '')
+        next_url = "last page reached"
+        if has_next:
+            next_from = (page[-1][0] + timedelta(days=1)).strftime('%Y-%m-%d')
+            next_url = f"/events/{event_id}/occurrences?from={next_from}&{query_string}"
+        response = {
+            'id': event_id,
+            'occurrences': [{
+                'date': str(start_time.date()),
+                'from': str(start_time.time()),
+                'to': str(end_time.time())
+            } for start_time, end_time in page],
+            '_links': {
+                'event': {
+                    'href': '/events/' + str(event_id)
+                },
+                'next': {
+                    'href': next_url
+                }
+            }
+        }
+        return response, 200
    
 # GET event frequency report, either by json or image
 @api.route('/events/statistics')
@@ -541,41 +1832,69 @@ class EventStats(Resource):
     @api.response(200, 'Events statistics successfully')
     @api.response(400, 'Invalid request')
     @api.doc(params={'format': 'The response format can be requested: json, image'})
+    @api.doc(params={'from': 'first date counted, YYYY-MM-DD (optional)'})
+    @api.doc(params={'to': 'last date counted, YYYY-MM-DD (optional)'})
+    @api.doc(params={'calendar': {'description':'calendar id, the default calendar when omitted','type': 'int', 'required': False}})
     def get(self):
-        session = Session()
         req_format = request.args.get('format', 'json')
-        
-        events = session.query(EventDB)
-        total = events.count()
-        total_current_week = sum(1 for event in events if event.start_time.isocalendar()[1] == datetime.now().isocalendar()[1])
-        total_current_month = sum(1 for event in events if event.start_time.month == datetime.now().month)
-        per_days = {}
-        for event in events:
-            date_str = event.start_time.strftime('%Y-%m-%d')
-            if date_str not in per_days:
-                per_days[date_str] = 1
-            else:
-                per_days[date_str] += 1
-                
+        statistics = event_statistics(db_session(), request.args)
+        version = payload_version(statistics)
+        if req_format not in ('json', 'image'):
+            abort(400, 'format not supported. Please use json or image.')
+        # the format is part of the tag, json and png are different representations
+        etag = version + '-' + req_format
+        if request.if_none_match.contains(etag):
+            return None, 304, {'ETag': '"' + etag + '"'}
+
         if req_format == 'json':
-            response = {
-                'total': total,
-                'total-current-week': total_current_week,
-                'total-current-month': total_current_month,
-                'per-days': per_days
-            }
-            return response, 200
+            response = statistics
+            return response, 200, {'ETag': '"' + etag + '"'}
         
         elif req_format == "image":
-            image = image_constructor(total, total_current_week, total_current_month, per_days)
+            image = io.BytesIO(cached_chart(version, statistics))
             response = send_file(image, mimetype='image/png')
             response.headers.set('content-type' , 'image/png')
+            response.set_etag(etag)
             response.status_code = 200     
             
             return response
-            
-        else:
-            abort(400, 'format not supported. Please use json or image.')
+
+# calendars partition the events, overlapping is only checked within a calendar
+@api.route('/calendars')
+class Calendars(Resource):
+# POST a calendar
+    @api.expect(calendar)
+    @api.response(201, 'Calendar created successfully')
+    @api.response(400, 'Invalid input')
+    def post(self):
+        calendar_parser = reqparse.RequestParser()
+        calendar_parser.add_argument('name', type=str, help='Name of the calendar', required=True)
+        calendar_parser.add_argument('owner', type=str, help='Owner of the calendar', required=False)
+        args = calendar_parser.parse_args()
+
+        session = db_session()
+        new_calendar = CalendarDB(name=args['name'], owner=args['owner'])
+        session.add(new_calendar)
+        session.commit()
+        calendar_ids.add(new_calendar.id)
+        return calendar_response(new_calendar), 201
+
+# GET all calendars
+    @api.response(200, 'Calendars retrieved successfully')
+    def get(self):
+        session = db_session()
+        return [calendar_response(c) for c in session.query(CalendarDB).order_by(CalendarDB.id)], 200
+
+@api.route('/calendars/<int:calendar_id>')
+class Calendar(Resource):
+    @api.response(200, 'Calendar retrieved successfully')
+    @api.response(404, 'Calendar not found')
+    def get(self, calendar_id):
+        session = db_session()
+        calendar_row = session.query(CalendarDB).filter_by(id=calendar_id).first()
+        if calendar_row is None:
+            abort(404, 'Calendar not found')
+        return calendar_response(calendar_row), 200
 
 # GET weather and geo informtion of the event
 # This part is not completely finished, current result is given in json format, due to failure of loading geopands library
@@ -585,49 +1904,37 @@ class Weather(Resource):
     @api.response(200, 'Weather forecast retrieved successfully')
     @api.response(400, 'Invalid request')
     @api.doc(params={'date': 'The date on which the forecast is demanded: DD-MM-YYYY'})
+    @api.doc(params={'cities': 'csv formatted city names from au.csv, defaults to the state and territory capitals'})
     def get(self):
-        now = datetime.now()
-        default_date = now.strftime('%d%m%Y')
-        try:
-            date_query = request.args.get('date', default_date)
-            date_obj = datetime.strptime(date_query, '%d-%m-%Y')
-            date = date_obj.strftime('%Y%m%d')
-        except:
-            abort(400, 'Invalid input, query date format should be  DD-MM-YYYY.')
-            
-        url = "http://www.7timer.info/bin/api.pl?"
-        cities = ['Sydney', 'Melbourne', 'Brisbane', 'Perth', 'Canberra', 'Adelaide', 'Hobart','Darwin']
-        geo_dict = {}
-        for city in cities:
-            city_info = df_au[df_au['city'] == city]
-            lon = city_info.iloc[0,2]
-            lat = city_info.iloc[0,1]
-            geo_dict.update({city:(float(lon),float(lat))})
-        
-        
-        weather_dict = {}
-        for city, lon_lat in geo_dict.items():
-            lon = lon_lat[0]
-            lat = lon_lat[1]
-            url = url + 'lon=' + str(lon) +'&lat=' + str(lat) + '&product=civillight&output=json'
-            response = requests.get(url)
-            
-            weather = "*no forecast made*"
-            if response.status_code == 200:
-                res = response.json()
-                for forecast in res['dataseries']:
-                    if str(forecast['date']) == str(date):
-                        weather = forecast['weather']
-            weather_dict.update({city: {'weather': weather, 'latitude': lat, 'longitude' : lon}})
-                
-        weather_response = weather_dict
+        date, geo_dict = weather_query(request.args)
+        # all cities are fetched concurrently, a city whose forecast does not arrive in time is reported without one
+        forecasts = weather_cache.get_many(list(geo_dict.values()), 'civillight', wait=WEATHER_TIMEOUT)
+        weather_response = weather_report(date, geo_dict, forecasts)
         return weather_response, 200
     
                 
         
 
+# GET service metrics in the Prometheus text format
+@api.route('/metrics')
+class Metrics(Resource):
+    @api.response(200, 'Metrics retrieved successfully')
+    def get(self):
+        extra = [
+            ('events_requests_total', 'counter', 'Requests served.', session_metrics['requests']),
+            ('events_db_sessions_total', 'counter', 'Database sessions opened by requests.', session_metrics['sessions']),
+            ('events_db_sessions_per_request_max', 'gauge', 'Most database sessions opened by one request.',
+             session_metrics['max-sessions-per-request']),
+            ('events_indexed_intervals', 'gauge', 'Events held by the in-process interval indexes.',
+             sum(len(interval_index) for interval_index in interval_indexes.values())),
+        ]
+        return Response(render_metrics(extra), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     #run command:python EventScheduler.py georef-australia-state-suburb.csv au.csv
+    #the dataset paths are optional, EVENTS_GEOREF_PATH and EVENTS_CITIES_PATH or the default names are used otherwise
+    app = create_app(dict(zip(('GEOREF_PATH', 'CITIES_PATH'), sys.argv[1:3])))
     #app.run(debug=True)
     app.run(debug=False)
     
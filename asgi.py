@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Async (ASGI) serving mode of the events API.
+
+GET /events, /events/<id>, /events/weather, /events/statistics and /weather are served on the
+event loop: events are read through an async SQLAlchemy engine and 7timer is
+called through one pooled httpx.AsyncClient, so a read waiting on an upstream
+holds a coroutine instead of a worker thread. Responses are built by the same
+help functions as the Flask app, and every other route (writes, bulk import,
+export, swagger) is the Flask app itself, mounted through a WSGI adapter.
+
+run command: python asgi.py georef-australia-state-suburb.csv au.csv
+or: uvicorn asgi:create_application --factory
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import sys
+
+import httpx
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from flask_restx import abort
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import HTTPException
+
+import EventScheduler as scheduler
+from metrics import instrument_engine, span
+from storage import make_async_engine, async_url, DATABASE_URL
+from upstream import cassette, CassetteMiss
+from weather import SEVENTIMER_URL, WEATHER_TIMEOUT, WEATHER_MISS_WAIT
+
+ASGI_HOST = os.environ.get('EVENTS_ASGI_HOST', '127.0.0.1')
+ASGI_PORT = int(os.environ.get('EVENTS_ASGI_PORT', 8000))
+UPSTREAM_CONNECTIONS = 100   # concurrent 7timer requests shared by all reads
+
+logger = logging.getLogger(__name__)
+
+# bound to the database of the Flask app by create_application
+async_engine = None
+async_source_url = None
+AsyncSession = async_sessionmaker(expire_on_commit=False)
+weather_cache = scheduler.weather_cache
+forecast_tasks = {}   # weather cache key -> task fetching it, one per cell however many reads wait
+
+
+@contextlib.asynccontextmanager
+async def lifespan(application):
+    limits = httpx.Limits(max_connections=UPSTREAM_CONNECTIONS, max_keepalive_connections=UPSTREAM_CONNECTIONS)
+    async with httpx.AsyncClient(timeout=WEATHER_TIMEOUT, limits=limits) as client:
+        application.state.http = client
+        yield
+    await async_engine.dispose()
+
+
+# help function - fetch one forecast into the shared weather cache
+async def fetch_forecast(client, key):
+    lat, lon, product = key
+    params = {'lon': lon, 'lat': lat, 'product': product, 'output': 'json'}
+    try:
+        if cassette is not None and cassette.mode == 'replay':
+            forecast = cassette.replay(SEVENTIMER_URL, params)
+        else:
+            response = await client.get(SEVENTIMER_URL, params=params)
+            response.raise_for_status()
+            forecast = response.json()
+            if cassette is not None:
+                cassette.record(SEVENTIMER_URL, params, forecast)
+    except (httpx.HTTPError, CassetteMiss, ValueError) as err:
+        logger.warning('weather refresh failed for %s: %s', key, err)
+        weather_cache.fail(key)
+        raise
+    finally:
+        forecast_tasks.pop(key, None)
+    weather_cache.store(key, forecast)
+    return forecast
+
+# help function - forecasts for several (lat, lon) cells, stale or missing ones refreshed concurrently;
+# cells that are still missing once `wait` seconds have passed come back as None
+async def get_forecasts(client, locations, product, wait):
+    results = []
+    pending = {}
+    for i, (lat, lon) in enumerate(locations):
+        key = weather_cache.key(lat, lon, product)
+        forecast, due = weather_cache.peek(key)
+        results.append(forecast)
+        if not due:
+            continue
+        task = forecast_tasks.get(key)
+        if task is None:
+            task = forecast_tasks[key] = asyncio.ensure_future(fetch_forecast(client, key))
+            # failures are already logged, a refresh nobody waits for must not warn again
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        if forecast is None:
+            pending[i] = task
+    if pending:
+        # the fetches outlive the wait and still fill the cache for the next read
+        done, _ = await asyncio.wait(set(pending.values()), timeout=wait)
+        for i, task in pending.items():
+            if task in done and task.exception() is None:
+                results[i] = task.result()
+    return results
+
+# help function - holiday name, off the event loop only when the year still has to be loaded
+async def holiday_name(event):
+    if scheduler.holiday_provider.is_loaded(event.start_time.year):
+        return scheduler.holidayAPI(event)
+    with span('holiday_name'):
+        return await asyncio.to_thread(scheduler.holidayAPI, event)
+
+# help function - the forecast covering the event, read from the shared cache or fetched without blocking
+async def weather_info(client, event):
+    place = scheduler.event_place(event)
+    if place is None:
+        return {}
+    with span('weather_info'):
+        forecast, = await get_forecasts(client, [place], 'civil', WEATHER_MISS_WAIT)
+    return scheduler.forecast_at(forecast, event.start_time)
+
+# help function - forecasts of many events, one civil request per grid cell
+async def batch_weather(client, events):
+    locations, event_cells = scheduler.weather_cells(events)
+    forecasts = await get_forecasts(client, locations, 'civil', WEATHER_MISS_WAIT) if locations else []
+    return scheduler.events_weather(events, event_cells, forecasts)
+
+# help function - whether an If-None-Match header names etag
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag[2:].strip('"') == etag if tag.startswith('W/') else tag.strip('"') == etag
+                              for tag in tags)
+
+# errors raised by abort() in the shared help functions, in the flask-restx error format
+async def http_error(request, exc):
+    return JSONResponse(getattr(exc, 'data', None) or {'message': exc.description}, status_code=exc.code)
+
+
+# GET a list of events, forecasts are fetched after the session is released
+async def list_events(request):
+    async with AsyncSession() as session:
+        calendar_id = await session.run_sync(scheduler.calendar_arg, request.query_params)
+        key = scheduler.page_response_key(calendar_id, request.query_params)
+        cached = scheduler.lookup_response(key)
+        if cached is None:
+            page = await session.run_sync(scheduler.query_event_page, request.query_params)
+    if cached is None:
+        weather = await batch_weather(request.app.state.http, page['events']) if page['weather'] else None
+        cached = scheduler.store_response(key, scheduler.event_page_response(page, weather),
+                                          final=scheduler.weather_final(weather))
+    body, etag = cached
+    headers = {'ETag': '"' + etag + '"'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(body, headers=headers)
+
+# GET the forecasts of several events at once
+async def events_weather(request):
+    event_ids = scheduler.weather_ids(request.query_params)
+    async with AsyncSession() as session:
+        events = (await session.execute(select(scheduler.EventDB).where(scheduler.EventDB.id.in_(event_ids)))).scalars().all()
+    weather = await batch_weather(request.app.state.http, events)
+    return JSONResponse(scheduler.events_weather_response(event_ids, events, weather))
+
+# GET an event, weather and holiday are looked up concurrently
+async def get_event(request):
+    event_id = request.path_params['event_id']
+    async with AsyncSession() as session:
+        event, previous_id, next_id = await session.run_sync(scheduler.find_adjacency, event_id)
+    if event is None:
+        abort(404, 'Event not found')
+    key = scheduler.event_response_key(event, previous_id, next_id)
+    cached = scheduler.lookup_response(key)
+    if cached is None:
+        weather, holiday = await asyncio.gather(weather_info(request.app.state.http, event), holiday_name(event))
+        cached = scheduler.store_response(key, scheduler.event_detail(event, previous_id, next_id, weather, holiday),
+                                          str(event.version) + '-', scheduler.weather_final([weather]))
+    body, etag = cached
+    headers = scheduler.event_validators(event, etag)
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(body, headers=headers)
+
+# GET event frequency report, either by json or image
+async def event_statistics(request):
+    req_format = request.query_params.get('format', 'json')
+    async with AsyncSession() as session:
+        statistics = await session.run_sync(scheduler.event_statistics, request.query_params)
+    version = scheduler.payload_version(statistics)
+    if req_format not in ('json', 'image'):
+        abort(400, 'format not supported. Please use json or image.')
+    etag = version + '-' + req_format
+    headers = {'ETag': '"' + etag + '"'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+
+    if req_format == 'json':
+        return JSONResponse(statistics, headers=headers)
+    # rendering is CPU bound, keep it off the event loop
+    png = await asyncio.to_thread(scheduler.cached_chart, version, statistics)
+    return Response(png, media_type='image/png', headers=headers)
+
+# GET weather of the requested cities
+async def weather(request):
+    date, geo_dict = scheduler.weather_query(request.query_params)
+    forecasts = await get_forecasts(request.app.state.http, list(geo_dict.values()), 'civillight', WEATHER_TIMEOUT)
+    return JSONResponse(scheduler.weather_report(date, geo_dict, forecasts))
+
+
+# config as for EventScheduler.create_app, other methods on these paths do not match here and fall through to the Flask app
+def create_application(config=None):
+    global async_engine, async_source_url
+    flask_app = scheduler.create_app(config)
+    if async_engine is None or async_source_url != scheduler.database_url:
+        # EVENTS_ASYNC_DATABASE_URL applies to the configured database, another one gets its derived URL
+        async_source_url = scheduler.database_url
+        async_engine = make_async_engine(None if async_source_url == DATABASE_URL else async_url(async_source_url))
+        instrument_engine(async_engine.sync_engine)
+        AsyncSession.configure(bind=async_engine)
+    return Starlette(
+        routes=[
+            Route('/events', list_events, methods=['GET']),
+            Route('/events/statistics', event_statistics, methods=['GET']),
+            Route('/events/weather', events_weather, methods=['GET']),
+            Route('/events/{event_id:int}', get_event, methods=['GET']),
+            Route('/weather', weather, methods=['GET']),
+            Mount('/', app=WSGIMiddleware(flask_app)),
+        ],
+        exception_handlers={HTTPException: http_error},
+        lifespan=lifespan,
+    )
+
+
+if __name__ == '__main__':
+    #run command:python asgi.py georef-australia-state-suburb.csv au.csv
+    uvicorn.run(create_application(dict(zip(('GEOREF_PATH', 'CITIES_PATH'), sys.argv[1:3]))), host=ASGI_HOST, port=ASGI_PORT)
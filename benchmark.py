@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the events API.
+
+Seeds a database of its own with synthetic, non-overlapping events, then drives
+the Flask app in process and reports throughput and latency percentiles of each
+operation as JSON. Weather and holidays are answered from canned data, so runs
+measure the service and not the upstreams. Passing a previous result with
+--baseline fails the run when an operation got slower than --tolerance allows.
+The contended operations aim several writes at the same slot or event; run them
+with --threads to check that parallel writers never store overlapping events or
+lose updates, which also fails the run.
+
+run command: python benchmark.py georef-australia-state-suburb.csv au.csv --events 100000 --output bench.json
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+BENCH_DATABASE = 'bench.db'
+SEED_CHUNK_SIZE = 10000
+SEED_START = datetime(2020, 1, 6, 8, 0)
+SEED_STEP = timedelta(hours=2)        # one event every two hours, an hour long, so every odd hour is free
+SEED_DURATION = timedelta(hours=1)
+SEED_PLACES = [('Maroubra', 'NSW', '2035'), ('Bondi', 'NSW', '2026'), ('Fitzroy', 'VIC', '3065'),
+               ('Toowong', 'QLD', '4066'), ('Glenelg', 'SA', '5045'), ('Fremantle', 'WA', '6160')]
+SEED_WORDS = ['planning', 'review', 'standup', 'workshop', 'lunch', 'training', 'retro', 'demo', 'hiring', 'budget']
+OPERATIONS = ['post', 'post_conflict', 'patch', 'list_first', 'list_deep_offset', 'list_deep_cursor',
+              'detail', 'statistics_json', 'statistics_image', 'post_contended', 'patch_contended']
+CONTENDERS = 4   # consecutive contended requests aimed at the same slot or event
+PERCENTILES = (50, 90, 99)
+
+# a full civil dataseries, the size of what 7timer returns
+CANNED_FORECAST = {
+    'init': '2020010600',
+    'dataseries': [{'timepoint': step, 'weather': 'clearday', 'wind10m': {'direction': 'N', 'speed': 2},
+                    'rh2m': '50%', 'temp2m': 20} for step in range(3, 195, 3)],
+}
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(description='Benchmark the events API')
+    parser.add_argument('georef', help='georef-australia-state-suburb.csv')
+    parser.add_argument('cities', help='au.csv')
+    parser.add_argument('--events', type=int, default=10000, help='events seeded before measuring')
+    parser.add_argument('--requests', type=int, default=500, help='requests per operation')
+    parser.add_argument('--threads', type=int, default=1, help='concurrent clients per operation')
+    parser.add_argument('--operations', default=','.join(OPERATIONS), help='comma separated subset of ' + ', '.join(OPERATIONS))
+    parser.add_argument('--database', default=BENCH_DATABASE, help='SQLite file, recreated unless --reuse')
+    parser.add_argument('--reuse', action='store_true', help='keep an already seeded database')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON result here as well as to stdout')
+    parser.add_argument('--baseline', help='JSON result of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p50 slowdown against the baseline')
+    return parser.parse_args()
+
+
+def seed_rows(count, rng):
+    for i in range(count):
+        start_time = SEED_START + i * SEED_STEP
+        suburb, state, post_code = SEED_PLACES[i % len(SEED_PLACES)]
+        yield {
+            'name': ' '.join(rng.sample(SEED_WORDS, 2)),
+            'start_time': start_time,
+            'end_time': start_time + SEED_DURATION,
+            'description': ' '.join(rng.sample(SEED_WORDS, 4)),
+            'last_updated': start_time,
+            'street': str(i % 200 + 1) + ' Main St',
+            'suburb': suburb,
+            'state': state,
+            'post_code': post_code,
+        }
+
+
+# bulk insert through the engine, the triggers keep the overlap and text indexes in step
+def seed(scheduler, count, rng):
+    rows = seed_rows(count, rng)
+    seeded = 0
+    with scheduler.engine.begin() as connection:
+        while seeded < count:
+            chunk = [row for _, row in zip(range(SEED_CHUNK_SIZE), rows)]
+            connection.execute(scheduler.insert(scheduler.EventDB), chunk)
+            seeded += len(chunk)
+
+
+def event_body(start_time, end_time, name='benchmark'):
+    suburb, state, post_code = SEED_PLACES[0]
+    return {
+        'name': name,
+        'date': start_time.strftime('%Y-%m-%d'),
+        'from': start_time.strftime('%H:%M:%S'),
+        'to': end_time.strftime('%H:%M:%S'),
+        'location': {'street': '1 Main St', 'suburb': suburb, 'state': state, 'post-code': post_code},
+        'description': 'benchmark event',
+    }
+
+
+# one request per call, each call gets its own argument drawn up front so threads never share state
+def make_operations(scheduler, client, count, rng):
+    with scheduler.Session() as session:
+        event_ids = [event_id for event_id, in session.query(scheduler.EventDB.id).order_by(scheduler.EventDB.id)]
+    page_size = 10
+    deep_page = max(1, int(len(event_ids) * 0.9) // page_size)
+    # the free hour after a seeded event, each POST takes a different one, skipping those a reused database filled,
+    # then one for every CONTENDERS contended POSTs
+    free_slots = []
+    for slot in rng.sample(range(len(event_ids)), len(event_ids)):
+        start_time = SEED_START + slot * SEED_STEP + SEED_DURATION + timedelta(minutes=10)
+        if not scheduler.detect_overlapping(scheduler.DEFAULT_CALENDAR_ID, start_time, start_time + timedelta(minutes=30)):
+            free_slots.append(start_time)
+            if len(free_slots) == count + count // CONTENDERS + 1:
+                break
+    contended_slots = free_slots[count:]
+
+    def post(i):
+        return client.post('/events', json=event_body(free_slots[i], free_slots[i] + timedelta(minutes=30))), 201
+
+    def post_conflict(i):
+        start_time = SEED_START + rng_choice(i) * SEED_STEP + timedelta(minutes=15)
+        return client.post('/events', json=event_body(start_time, start_time + timedelta(minutes=30))), 409
+
+    def patch(i):
+        return client.patch('/events/' + str(event_ids[rng_choice(i)]), json={'description': 'patched ' + str(i)}), 200
+
+    def list_first(i):
+        return client.get('/events?size=' + str(page_size)), 200
+
+    def list_deep_offset(i):
+        return client.get('/events?size=' + str(page_size) + '&page=' + str(deep_page - i % 10)), 200
+
+    def list_deep_cursor(i):
+        cursor = scheduler.encode_cursor('+id', [event_ids[len(event_ids) * 9 // 10 - i % 10]])
+        return client.get('/events?size=' + str(page_size) + '&cursor=' + cursor), 200
+
+    def detail(i):
+        return client.get('/events/' + str(event_ids[rng_choice(i)])), 200
+
+    # every request renders from scratch, the caches would otherwise answer all but the first
+    def statistics_json(i):
+        scheduler.statistics_cache.clear()
+        return client.get('/events/statistics?format=json'), 200
+
+    def statistics_image(i):
+        scheduler.statistics_cache.clear()
+        scheduler.chart_cache.clear()
+        return client.get('/events/statistics?format=image'), 200
+
+    # only the first POST of a slot is stored, the others see it and get a 409
+    def post_contended(i):
+        start_time = contended_slots[i // CONTENDERS]
+        return client.post('/events', json=event_body(start_time, start_time + timedelta(minutes=30))), (201, 409)
+
+    # every PATCH is applied, each one bumping the version of the event
+    def patch_contended(i):
+        return client.patch('/events/' + str(event_ids[i % CONTENDERS]), json={'description': 'contended ' + str(i)}), 200
+
+    choices = [rng.randrange(len(event_ids)) for _ in range(count)]
+
+    def rng_choice(i):
+        return choices[i]
+
+    return {name: function for name, function in locals().items() if name in OPERATIONS}
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def measure(operation, count, threads):
+    def timed(i):
+        started = time.perf_counter()
+        response, expected = operation(i)
+        return time.perf_counter() - started, response.status_code in (expected if isinstance(expected, tuple) else (expected,))
+
+    # call 0 was the warm-up
+    started = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            samples = list(executor.map(timed, range(1, count + 1)))
+    else:
+        samples = [timed(i) for i in range(1, count + 1)]
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency * 1000 for latency, _ in samples)
+    result = {
+        'requests': count,
+        'errors': sum(1 for _, ok in samples if not ok),
+        'throughput_rps': round(count / elapsed, 1),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'max_ms': round(latencies[-1], 3),
+    }
+    for p in PERCENTILES:
+        result['p' + str(p) + '_ms'] = round(percentile(latencies, p), 3)
+    return result
+
+
+# operations whose p50 grew by more than tolerance, as (name, baseline ms, current ms)
+def regressions(result, baseline, tolerance):
+    slower = []
+    for name, current in result['results'].items():
+        previous = baseline['results'].get(name)
+        if previous and current['p50_ms'] > previous['p50_ms'] * (1 + tolerance):
+            slower.append((name, previous['p50_ms'], current['p50_ms']))
+    return slower
+
+
+# versions of the events patch_contended writes to, added up
+def contended_versions(scheduler):
+    with scheduler.Session() as session:
+        return sum(version for version, in session.query(scheduler.EventDB.version)
+                   .order_by(scheduler.EventDB.id).limit(CONTENDERS))
+
+
+# one-off events starting before an earlier event of their calendar ends, zero unless a write raced past the checks
+def overlapping_events(scheduler):
+    with scheduler.engine.connect() as connection:
+        return connection.execute(scheduler.text(
+            "SELECT COUNT(*) FROM (SELECT start_time, MAX(end_time) OVER (PARTITION BY calendar_id ORDER BY start_time, id "
+            "ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS previous_end FROM events WHERE rrule IS NULL) ordered "
+            "WHERE start_time <= previous_end")).scalar()
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    options = parse_options()
+    operations = [name.strip() for name in options.operations.split(',') if name.strip()]
+    unknown = [name for name in operations if name not in OPERATIONS]
+    if unknown:
+        sys.exit('unknown operation ' + ', '.join(unknown))
+    if options.events <= options.requests + options.requests // CONTENDERS + 1:
+        sys.exit('--events must be larger than --requests, every POST takes a different free slot')
+    if not options.reuse:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(options.database + suffix):
+                os.remove(options.database + suffix)
+
+    import sqlalchemy
+    import EventScheduler as scheduler
+    from holiday import HolidayProvider
+    from weather import WeatherCache
+
+    app = scheduler.create_app({
+        'DATABASE_URL': 'sqlite+pysqlite:///' + options.database,
+        'GEOREF_PATH': options.georef,
+        'CITIES_PATH': options.cities,
+        'PRELOAD_DATASETS': True,
+        'PRELOAD_HOLIDAYS': False,
+    })
+    scheduler.weather_cache = WeatherCache(fetch=lambda lat, lon, product: CANNED_FORECAST)
+    scheduler.holiday_provider = HolidayProvider('AU', sources=('file',))
+
+    rng = random.Random(options.seed)
+    with scheduler.Session() as session:
+        seeded = session.query(scheduler.func.count(scheduler.EventDB.id)).scalar()
+    seed_started = time.perf_counter()
+    if seeded < options.events:
+        seed(scheduler, options.events - seeded, rng)
+        scheduler.load_interval_index()
+    seed_seconds = time.perf_counter() - seed_started
+
+    client = app.test_client()
+    functions = make_operations(scheduler, client, options.requests + 1, rng)
+    result = {
+        'meta': {
+            'events': max(seeded, options.events),
+            'requests': options.requests,
+            'threads': options.threads,
+            'seed_seconds': round(seed_seconds, 2),
+            'database': scheduler.engine.url.render_as_string(hide_password=True),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'date': datetime.now().isoformat(timespec='seconds'),
+        },
+        'results': {},
+    }
+    for name in operations:
+        # warm up code paths and caches that are not under test
+        functions[name](0)
+        versions = contended_versions(scheduler) if name == 'patch_contended' else None
+        result['results'][name] = measure(functions[name], options.requests, options.threads)
+        if versions is not None:
+            applied = options.requests - result['results'][name]['errors']
+            result['results'][name]['lost_updates'] = applied - (contended_versions(scheduler) - versions)
+    overlapping = overlapping_events(scheduler)
+    result['meta']['overlapping_events'] = overlapping
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    lost = sum(operation.get('lost_updates', 0) for operation in result['results'].values())
+    if overlapping or lost:
+        print('integrity: %d overlapping events, %d lost updates' % (overlapping, lost), file=sys.stderr)
+        sys.exit(1)
+    if options.baseline:
+        with open(options.baseline) as f:
+            slower = regressions(result, json.load(f), options.tolerance)
+        for name, before, after in slower:
+            print('regression: %s p50 %.3f ms -> %.3f ms' % (name, before, after), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
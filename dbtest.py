@@ -9,7 +9,7 @@ from flask_restx import Api, Resource, fields, reqparse, abort
 from datetime import datetime
 from sqlalchemy import create_engine, Column, Integer, String, Date
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 # Initialize database
 Base = declarative_base()
@@ -32,7 +32,8 @@ class Holiday(Base):
 engine = create_engine("sqlite:///holidays.db", echo=True, future=True)
 Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
-session = Session()
+# one session per request thread instead of a single session shared by all threads
+session = scoped_session(Session)
 
 # Initialize application
 app = Flask(__name__)
@@ -41,6 +42,10 @@ api = Api(app, version='1.0', title="Holiday API",
     default='Method', default_label='all methods are listed here'
 )
 
+@app.teardown_appcontext
+def remove_session(exception=None):
+    session.remove()
+
 # Define holiday models
 holiday = api.model('Holiday', {
     'name': fields.String(required=True),
@@ -78,7 +83,6 @@ class Holidays(Resource):
             description=str(args['description'])
         )
 
-        session = Session()
         session.add(new_holiday)
         session.commit()
 
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the 7timer and Nager.Date APIs.
+
+Serves /bin/api.pl (civil and civillight products) and
+/api/v2/publicholidays/<year>/<country> with documents shaped like the real
+ones. Forecasts are generated from the coordinates alone and holidays come from
+the bundled Holiday-<country>.json, so the same request always gets the same
+answer. Latency and an error rate can be injected to see how the service behaves
+against a slow or flaky upstream.
+
+run command: python fakeupstream.py --port 8100 --latency 0.2 --jitter 0.1 --error-rate 0.05
+then start the service with
+EVENTS_SEVENTIMER_BASE_URL=http://127.0.0.1:8100 EVENTS_NAGER_BASE_URL=http://127.0.0.1:8100
+"""
+import argparse
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import random
+import threading
+import time
+import zlib
+
+from flask import Flask, jsonify, request, abort
+
+WEATHER_TYPES = ('clearday', 'pcloudyday', 'mcloudyday', 'cloudyday', 'humidday', 'lightrainday',
+                 'oshowerday', 'ishowerday', 'lightsnowday', 'rainday', 'snowday', 'rainsnowday')
+LIGHT_WEATHER_TYPES = ('clear', 'pcloudy', 'mcloudy', 'cloudy', 'humid', 'lightrain',
+                       'oshower', 'ishower', 'lightsnow', 'rain', 'snow', 'rainsnow', 'ts', 'tsrain')
+CIVIL_STEPS = 64         # 3-hourly steps, 8 days like 7timer
+CIVILLIGHT_DAYS = 7
+HOLIDAY_JSON_PATTERN = "Holiday-{country}.json"
+
+app = Flask(__name__)
+settings = {'latency': 0.0, 'jitter': 0.0, 'error_rate': 0.0}
+rng = random.Random(0)
+rng_lock = threading.Lock()
+
+
+# help function - sleep for the configured latency and maybe fail, before answering a request
+@app.before_request
+def inject_faults():
+    with rng_lock:
+        delay = settings['latency'] + rng.uniform(0, settings['jitter'])
+        failing = rng.random() < settings['error_rate']
+    if delay > 0:
+        time.sleep(delay)
+    if failing:
+        abort(503)
+
+
+# help function - a generator seeded by the request, so repeated requests agree
+def seeded(*parts):
+    return random.Random(zlib.crc32('|'.join(str(part) for part in parts).encode()))
+
+
+# the latest 00 or 12 UTC run, as 7timer issues them
+def forecast_init(now):
+    return now.replace(hour=0 if now.hour < 12 else 12, minute=0, second=0, microsecond=0)
+
+
+def civil(lat, lon, init):
+    r = seeded(lat, lon, init)
+    base = r.uniform(5, 30)
+    dataseries = []
+    for step in range(1, CIVIL_STEPS + 1):
+        dataseries.append({
+            'timepoint': step * 3,
+            'cloudcover': r.randint(1, 9),
+            'lifted_index': r.choice((-4, -1, 2, 6, 10, 15)),
+            'prec_type': 'none',
+            'prec_amount': 0,
+            'temp2m': round(base + r.uniform(-5, 5)),
+            'rh2m': str(r.randint(20, 100)) + '%',
+            'wind10m': {'direction': r.choice(('N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW')), 'speed': r.randint(1, 8)},
+            'weather': r.choice(WEATHER_TYPES),
+        })
+    return dataseries
+
+
+def civillight(lat, lon, init):
+    r = seeded(lat, lon, init.date())
+    base = r.uniform(5, 30)
+    dataseries = []
+    for day in range(CIVILLIGHT_DAYS):
+        low = round(base + r.uniform(-8, 0))
+        dataseries.append({
+            'date': int((init + timedelta(days=day)).strftime('%Y%m%d')),
+            'weather': r.choice(LIGHT_WEATHER_TYPES),
+            'temp2m': {'max': low + r.randint(3, 12), 'min': low},
+            'wind10m_max': r.randint(1, 6),
+        })
+    return dataseries
+
+
+# 7timer forecast API
+@app.route('/bin/api.pl')
+def seventimer():
+    try:
+        lat = round(float(request.args['lat']), 3)
+        lon = round(float(request.args['lon']), 3)
+    except (KeyError, ValueError):
+        abort(400)
+    product = request.args.get('product', 'civil')
+    init = forecast_init(datetime.now(timezone.utc).replace(tzinfo=None))
+    if product == 'civil':
+        dataseries = civil(lat, lon, init)
+    elif product == 'civillight':
+        dataseries = civillight(lat, lon, init)
+    else:
+        abort(400)
+    return jsonify({'product': product, 'init': init.strftime('%Y%m%d%H'), 'dataseries': dataseries})
+
+
+# Nager.Date public holidays, from the bundled export of the country
+@app.route('/api/v2/publicholidays/<int:year>/<country>')
+def public_holidays(year, country):
+    path = HOLIDAY_JSON_PATTERN.format(country=country.upper())
+    if not os.path.exists(path):
+        abort(404)
+    with open(path, encoding='utf-8') as f:
+        holidays = json.load(f)
+    prefix = str(year) + '-'
+    return jsonify([holiday for holiday in holidays if holiday['date'].startswith(prefix)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake 7timer and Nager.Date upstream')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds, uniformly')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the latency and error draws')
+    options = parser.parse_args()
+    settings.update(latency=options.latency, jitter=options.jitter, error_rate=options.error_rate)
+    rng.seed(options.seed)
+    app.run(host=options.host, port=options.port, threaded=True)
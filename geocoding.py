@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Suburb and city geocoding for the weather lookups.
+
+The georef-australia-state-suburb.csv and au.csv datasets are parsed into hash
+indexes of normalized names pointing into float lat/lon arrays, so a lookup is
+a dictionary hit instead of a pandas boolean mask. Parsing happens on first use.
+
+The parsed datasets are written once to a columnar file (sorted, interned
+name and state strings with float32 lat/lon columns) that is memory-mapped read
+only. Lookups binary-search the mapped columns instead of building dictionaries,
+so every worker process shares the same page-cache copy of the gazetteer, and
+the file is reused across restarts for as long as the csv file is unchanged.
+"""
+from array import array
+import csv
+import difflib
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+
+STATE_CODES = {
+    'new south wales': 'NSW', 'victoria': 'VIC', 'queensland': 'QLD',
+    'south australia': 'SA', 'western australia': 'WA', 'tasmania': 'TAS',
+    'australian capital territory': 'ACT', 'northern territory': 'NT',
+}
+FALLBACK_CUTOFF = 0.8   # minimum similarity for the nearest-suburb fallback
+FALLBACK_CACHE_SIZE = 4096
+GAZETTEER_CACHE_DIR = os.environ.get('EVENTS_GAZETTEER_CACHE_DIR', '.gazetteer-cache')
+GAZETTEER_CACHE_FORMAT = 2   # bump whenever the file layout changes
+COORD_DIGITS = 5             # float32 keeps about 7 significant digits, lookups are rounded back to the source precision
+
+# magic, format, byte order probe, source size, source mtime, source path hash,
+# names, entries, states, name bytes, state bytes
+_HEADER = struct.Struct('=4sIIQq8sIIIII')
+_MAGIC = b'GAZM'
+_BYTE_ORDER_PROBE = 0x01020304
+_ALL_STATES = object()   # key of every name in the fallback candidates
+
+logger = logging.getLogger(__name__)
+
+_SUFFIX = re.compile(r'\s*\([^)]*\)\s*$')
+_SPACES = re.compile(r'\s+')
+
+
+# 'Paddington (NSW)' -> 'paddington'
+def normalize_name(name):
+    name = _SUFFIX.sub('', str(name))
+    return _SPACES.sub(' ', name).strip().lower()
+
+
+def normalize_state(state):
+    state = _SPACES.sub(' ', str(state)).strip().lower()
+    return STATE_CODES.get(state, state.upper())
+
+
+class Gazetteer:
+
+    def __init__(self):
+        self.lats = array('d')
+        self.lons = array('d')
+        self._by_name_state = {}   # (name, state) -> row
+        self._by_name = {}         # name -> first row
+        self._names_by_state = {}  # state -> [name, ...] for the fallback
+        self._fallbacks = {}       # (name, state) -> row or None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lats)
+
+    # (name, [(state, lat, lon), ...]) sorted by name, the first place of a name is the one lookup falls back to
+    def places(self):
+        by_name = {}
+        for (name, state), row in self._by_name_state.items():
+            by_name.setdefault(name, []).append((row, state))
+        for name in sorted(by_name, key=lambda name: name.encode()):
+            yield name, [(state, self.lats[row], self.lons[row]) for row, state in sorted(by_name[name])]
+
+    def add(self, name, state, lat, lon):
+        row = len(self.lats)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        name = normalize_name(name)
+        state = normalize_state(state) if state else None
+        if (name, state) not in self._by_name_state:
+            self._by_name_state[(name, state)] = row
+            self._names_by_state.setdefault(state, []).append(name)
+        self._by_name.setdefault(name, row)
+        return row
+
+    # (lat, lon) of the named place, falling back to the closest spelt name, or None
+    def lookup(self, name, state=None):
+        name = normalize_name(name)
+        state = normalize_state(state) if state else None
+        row = self._by_name_state.get((name, state))
+        if row is None:
+            row = self._by_name.get(name)
+        if row is None:
+            row = self._nearest(name, state)
+        if row is None:
+            return None
+        return self.lats[row], self.lons[row]
+
+    def _nearest(self, name, state):
+        key = (name, state)
+        with self._lock:
+            if key in self._fallbacks:
+                return self._fallbacks[key]
+        candidates = self._names_by_state.get(state) if state else None
+        if not candidates:
+            candidates = list(self._by_name)
+        match = difflib.get_close_matches(name, candidates, n=1, cutoff=FALLBACK_CUTOFF)
+        row = None
+        if match:
+            row = self._by_name_state.get((match[0], state), self._by_name.get(match[0]))
+        with self._lock:
+            if len(self._fallbacks) >= FALLBACK_CACHE_SIZE:
+                self._fallbacks.clear()
+            self._fallbacks[key] = row
+        return row
+
+
+# georef-australia-state-suburb.csv, 'Geo Point' holds "lat, lon"
+def load_suburbs(path):
+    gazetteer = Gazetteer()
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for record in csv.DictReader(f, delimiter=';'):
+            try:
+                lat, lon = (float(v) for v in record['Geo Point'].split(','))
+            except (KeyError, ValueError, AttributeError):
+                continue
+            gazetteer.add(record['Official Name Suburb'], record.get('Official Name State'), lat, lon)
+    return gazetteer
+
+
+# au.csv, one row per city with lat, lng and the state name in admin_name
+def load_cities(path):
+    gazetteer = Gazetteer()
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for record in csv.DictReader(f):
+            try:
+                lat, lon = float(record['lat']), float(record['lng'])
+            except (KeyError, ValueError):
+                continue
+            gazetteer.add(record['city'], record.get('admin_name'), lat, lon)
+    return gazetteer
+
+
+# state and territory capitals listed in au.csv, in file order
+def load_capitals(path):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return [record['city'] for record in csv.DictReader(f)
+                if record.get('capital') in ('primary', 'admin')]
+
+
+class MappedGazetteer:
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, file_format, probe, self.source_size, self.source_mtime_ns, self.source_hash,
+             names, entries, states, name_bytes, state_bytes) = _HEADER.unpack_from(self._map)
+        except struct.error:
+            self._map.close()
+            raise
+        if magic != _MAGIC or file_format != GAZETTEER_CACHE_FORMAT or probe != _BYTE_ORDER_PROBE:
+            self._map.close()
+            raise ValueError('not a gazetteer file of this format and byte order')
+        sections = _layout(names, entries, states, name_bytes, state_bytes)
+        if len(self._map) < sections['states'][1]:
+            self._map.close()
+            raise ValueError('truncated gazetteer file')
+        view = self._view = memoryview(self._map)
+        self._name_offsets = view[slice(*sections['name_offsets'])].cast('I')
+        self._entry_starts = view[slice(*sections['entry_starts'])].cast('I')
+        self._entry_states = view[slice(*sections['entry_states'])].cast('H')
+        self._lats = view[slice(*sections['lats'])].cast('f')
+        self._lons = view[slice(*sections['lons'])].cast('f')
+        self._names_start = sections['names'][0]
+        state_offsets = view[slice(*sections['state_offsets'])].cast('I')
+        state_blob = self._map[slice(*sections['states'])]
+        # a handful of strings, decoded once per process
+        self._states = [state_blob[state_offsets[i]:state_offsets[i + 1]].decode() or None for i in range(states)]
+        state_offsets.release()
+        self._state_ids = {state: i for i, state in enumerate(self._states)}
+        self._names = names
+        self._names_by_state = None
+        self._fallbacks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lats)
+
+    # unmap the file, the views into it have to be released first
+    def close(self):
+        for view in (self._name_offsets, self._entry_starts, self._entry_states, self._lats, self._lons, self._view):
+            view.release()
+        self._map.close()
+
+    # (lat, lon) of the named place, falling back to the closest spelt name, or None
+    def lookup(self, name, state=None):
+        name = normalize_name(name)
+        state = normalize_state(state) if state else None
+        name_id = self._name_id(name)
+        if name_id is None:
+            name_id = self._nearest(name, state)
+        if name_id is None:
+            return None
+        entry = self._entry(name_id, state)
+        return round(self._lats[entry], COORD_DIGITS), round(self._lons[entry], COORD_DIGITS)
+
+    def _name(self, name_id):
+        start = self._names_start
+        return self._map[start + self._name_offsets[name_id]:start + self._name_offsets[name_id + 1]]
+
+    # position of the name in the sorted name column, or None
+    def _name_id(self, name):
+        key = name.encode()
+        lo, hi = 0, self._names
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self._names and self._name(lo) == key else None
+
+    # the entry of the name in state, else its first entry
+    def _entry(self, name_id, state):
+        first, end = self._entry_starts[name_id], self._entry_starts[name_id + 1]
+        state_id = self._state_ids.get(state)
+        if state_id is not None:
+            for entry in range(first, end):
+                if self._entry_states[entry] == state_id:
+                    return entry
+        return first
+
+    def _nearest(self, name, state):
+        key = (name, state)
+        with self._lock:
+            if key in self._fallbacks:
+                return self._fallbacks[key]
+            if self._names_by_state is None:
+                # only misspelt lookups need the names as strings, they are decoded on the first one
+                self._names_by_state = {}
+                for name_id in range(self._names):
+                    candidate = self._name(name_id).decode()
+                    for entry in range(self._entry_starts[name_id], self._entry_starts[name_id + 1]):
+                        self._names_by_state.setdefault(self._states[self._entry_states[entry]], []).append(candidate)
+                self._names_by_state[_ALL_STATES] = [self._name(name_id).decode() for name_id in range(self._names)]
+        candidates = self._names_by_state.get(state) if state else None
+        if not candidates:
+            candidates = self._names_by_state[_ALL_STATES]
+        match = difflib.get_close_matches(name, candidates, n=1, cutoff=FALLBACK_CUTOFF)
+        name_id = self._name_id(match[0]) if match else None
+        with self._lock:
+            if len(self._fallbacks) >= FALLBACK_CACHE_SIZE:
+                self._fallbacks.clear()
+            self._fallbacks[key] = name_id
+        return name_id
+
+
+# (start, end) byte ranges of the sections of a gazetteer file, each aligned to 8 bytes
+def _layout(names, entries, states, name_bytes, state_bytes):
+    lengths = [
+        ('name_offsets', 4 * (names + 1)),
+        ('entry_starts', 4 * (names + 1)),
+        ('entry_states', 2 * entries),
+        ('lats', 4 * entries),
+        ('lons', 4 * entries),
+        ('state_offsets', 4 * (states + 1)),
+        ('names', name_bytes),
+        ('states', state_bytes),
+    ]
+    sections = {}
+    position = _HEADER.size
+    for section, length in lengths:
+        position += -position % 8
+        sections[section] = (position, position + length)
+        position += length
+    return sections
+
+
+def write_mapped(gazetteer, path, source_size, source_mtime_ns, source_hash):
+    name_offsets, entry_starts = array('I', [0]), array('I', [0])
+    entry_states, lats, lons = array('H'), array('f'), array('f')
+    state_ids = {None: 0}
+    names = bytearray()
+    for name, places in gazetteer.places():
+        names += name.encode()
+        name_offsets.append(len(names))
+        for state, lat, lon in places:
+            entry_states.append(state_ids.setdefault(state, len(state_ids)))
+            lats.append(lat)
+            lons.append(lon)
+        entry_starts.append(len(lats))
+    state_offsets, states = array('I', [0]), bytearray()
+    for state in state_ids:
+        states += (state or '').encode()
+        state_offsets.append(len(states))
+
+    sections = _layout(len(name_offsets) - 1, len(lats), len(state_ids), len(names), len(states))
+    header = _HEADER.pack(_MAGIC, GAZETTEER_CACHE_FORMAT, _BYTE_ORDER_PROBE, source_size, source_mtime_ns,
+                          source_hash, len(name_offsets) - 1, len(lats), len(state_ids), len(names), len(states))
+    with open(path, 'wb') as f:
+        f.write(header)
+        for section, data in (('name_offsets', name_offsets), ('entry_starts', entry_starts),
+                              ('entry_states', entry_states), ('lats', lats), ('lons', lons),
+                              ('state_offsets', state_offsets), ('names', names), ('states', states)):
+            f.write(b'\0' * (sections[section][0] - f.tell()))
+            f.write(data if isinstance(data, bytearray) else data.tobytes())
+        # on disk before it is renamed into place, a crash never leaves a short file under the cache name
+        f.flush()
+        os.fsync(f.fileno())
+    return sections
+
+
+# the gazetteer of a csv through loader, mapped from the cache file when it was built from this very file
+def load_cached(path, loader, cache_dir=GAZETTEER_CACHE_DIR):
+    stat = os.stat(path)
+    source_hash = hashlib.sha1(os.path.abspath(path).encode()).digest()[:8]
+    cache_path = os.path.join(cache_dir, '%s-%s.gaz' % (loader.__name__, source_hash.hex()))
+    try:
+        gazetteer = MappedGazetteer(cache_path)
+        if (gazetteer.source_size, gazetteer.source_mtime_ns, gazetteer.source_hash) == (stat.st_size, stat.st_mtime_ns, source_hash):
+            return gazetteer
+        gazetteer.close()
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, struct.error) as err:
+        logger.warning('rebuilding unreadable gazetteer cache %s: %s', cache_path, err)
+
+    gazetteer = loader(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written whole and swapped in, workers mapping the old file keep reading it until they reopen
+        temporary = cache_path + '.%d.tmp' % os.getpid()
+        write_mapped(gazetteer, temporary, stat.st_size, stat.st_mtime_ns, source_hash)
+        os.replace(temporary, cache_path)
+        return MappedGazetteer(cache_path)
+    except OSError as err:
+        logger.warning('could not write gazetteer cache %s, keeping it in memory: %s', cache_path, err)
+        return gazetteer
+
+
+# suburbs, cities and capitals of the two datasets, each parsed on first use
+class GeoData:
+
+    def __init__(self, georef_path, cities_path, cache_dir=GAZETTEER_CACHE_DIR):
+        self.georef_path = georef_path
+        self.cities_path = cities_path
+        self.cache_dir = cache_dir
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def suburbs(self):
+        return self._get('suburbs', lambda: load_cached(self.georef_path, load_suburbs, self.cache_dir))
+
+    @property
+    def cities(self):
+        return self._get('cities', lambda: load_cached(self.cities_path, load_cities, self.cache_dir))
+
+    @property
+    def capitals(self):
+        return self._get('capitals', lambda: load_capitals(self.cities_path))
+
+    # parse everything now, e.g. before forking workers or serving the first request
+    def preload(self):
+        return self.suburbs, self.cities, self.capitals
+
+    def _get(self, name, load):
+        value = self._loaded.get(name)
+        if value is None:
+            with self._lock:
+                value = self._loaded.get(name)
+                if value is None:
+                    value = self._loaded[name] = load()
+        return value
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Public holiday lookup backed by per-year in-memory tables.
+
+Each (year, country) holiday list is loaded once, from Nager.Date, from a
+bundled JSON export such as Holiday-AU.json, or from the holidays.db database
+maintained by dbtest.py, and indexed by (date, state). Lookups are dictionary
+hits; tables are refreshed in the background once they get old.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+
+from upstream import get_json, NAGER_BASE_URL
+
+NAGER_URL = NAGER_BASE_URL + "/api/v2/publicholidays"
+HOLIDAY_DB_URL = "sqlite:///holidays.db"
+HOLIDAY_JSON_PATTERN = "Holiday-{country}.json"
+HOLIDAY_REFRESH = 24 * 3600      # seconds before a loaded year is refreshed
+HOLIDAY_RETRY_AFTER = 300        # seconds before a year that failed to load is retried
+HOLIDAY_SOURCES = ('network', 'file', 'database')   # the first source with data wins
+
+logger = logging.getLogger(__name__)
+
+
+class HolidayProvider:
+
+    def __init__(self, country='AU', sources=HOLIDAY_SOURCES, offline=False,
+                 refresh_interval=HOLIDAY_REFRESH, retry_after=HOLIDAY_RETRY_AFTER,
+                 db_url=HOLIDAY_DB_URL, json_path=None):
+        self.country = country
+        self.offline = offline
+        self.sources = tuple(s for s in sources if not (offline and s == 'network'))
+        self.refresh_interval = refresh_interval
+        self.retry_after = retry_after
+        self.db_url = db_url
+        self.json_path = json_path or HOLIDAY_JSON_PATTERN.format(country=country)
+        self._tables = {}      # year -> (expires_at, {(date, county or None): name})
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    # name of the holiday on date in state ('NSW', 'VIC', ...), or None
+    def lookup(self, date, state=None):
+        table = self._table(date.year)
+        date_str = date.strftime('%Y-%m-%d')
+        if state is not None:
+            name = table.get((date_str, self.country + '-' + state))
+            if name is not None:
+                return name
+        return table.get((date_str, None))
+
+    # whether lookups in year are answered from memory, without loading the year first
+    def is_loaded(self, year):
+        return year in self._tables
+
+    # load the given years in a background thread so startup does not wait on the network
+    def preload(self, years):
+        thread = threading.Thread(target=lambda: [self._table(year) for year in years],
+                                  name='holiday-preload', daemon=True)
+        thread.start()
+        return thread
+
+    def _table(self, year):
+        loaded = self._tables.get(year)
+        if loaded is None:
+            with self._load_lock(year):
+                loaded = self._tables.get(year)
+                if loaded is None:
+                    loaded = self._load(year)
+        elif loaded[0] < time.monotonic():
+            self._refresh_in_background(year)
+        return loaded[1]
+
+    def _load_lock(self, year):
+        with self._lock:
+            return self._load_locks.setdefault(year, threading.Lock())
+
+    def _refresh_in_background(self, year):
+        with self._lock:
+            if year in self._refreshing:
+                return
+            self._refreshing.add(year)
+
+        def refresh():
+            try:
+                self._load(year)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(year)
+
+        threading.Thread(target=refresh, name='holiday-refresh', daemon=True).start()
+
+    def _load(self, year):
+        for source in self.sources:
+            try:
+                holidays = getattr(self, '_from_' + source)(year)
+            except Exception as err:
+                logger.warning('loading %s holidays for %s from %s failed: %s',
+                               self.country, year, source, err)
+                continue
+            if holidays:
+                loaded = (time.monotonic() + self.refresh_interval, self._index(holidays))
+                break
+        else:
+            # keep serving the previous table if there is one, retry later
+            previous = self._tables.get(year, (None, {}))[1]
+            loaded = (time.monotonic() + self.retry_after, previous)
+        self._tables[year] = loaded
+        return loaded
+
+    @staticmethod
+    def _index(holidays):
+        table = {}
+        for holiday in holidays:
+            for county in holiday.get('counties') or [None]:
+                table.setdefault((holiday['date'], county), holiday['name'])
+        return table
+
+    def _from_network(self, year):
+        return get_json(NAGER_URL + '/' + str(year) + '/' + self.country)
+
+    # holidays.db has no state information, its entries apply nationwide
+    def _from_database(self, year):
+        if self.db_url.startswith('sqlite:///') and not os.path.exists(self.db_url[len('sqlite:///'):]):
+            return []
+        engine = create_engine(self.db_url, future=True)
+        try:
+            with engine.connect() as connection:
+                rows = connection.execute(
+                    text("SELECT name, date FROM holidays WHERE date LIKE :year"),
+                    {'year': str(year) + '-%'})
+                return [{'name': name, 'date': str(date)[:10], 'counties': None} for name, date in rows]
+        finally:
+            engine.dispose()
+
+    def _from_file(self, year):
+        if not os.path.exists(self.json_path):
+            return []
+        with open(self.json_path, encoding='utf-8') as f:
+            holidays = json.load(f)
+        prefix = str(year) + '-'
+        return [holiday for holiday in holidays if holiday['date'].startswith(prefix)]
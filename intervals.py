@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+In-process interval index used for event overlap detection.
+
+Intervals are kept sorted by start time so that an overlap probe only has to
+look at the events starting inside [start - longest span, end] instead of
+scanning the whole events table. Recurring events are kept apart, one entry
+per rule, and only the occurrences falling inside a probe are expanded.
+"""
+from bisect import bisect_left, bisect_right, insort
+from datetime import timedelta
+import threading
+
+
+class IntervalIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._starts = []      # sorted (start_time, id) keys
+        self._intervals = {}   # id -> (start_time, end_time)
+        self._max_span = timedelta(0)
+        self._series = {}      # id -> (start_time, end_time, recurrence, last end or None) of recurring intervals
+
+    def __len__(self):
+        return len(self._intervals) + len(self._series)
+
+    def __contains__(self, interval_id):
+        return interval_id in self._intervals or interval_id in self._series
+
+    # rebuild the index from (id, start_time, end_time, recurrence or None) rows
+    def load(self, rows):
+        with self._lock:
+            self._starts = []
+            self._intervals = {}
+            self._series = {}
+            self._max_span = timedelta(0)
+            for interval_id, start_time, end_time, recurrence in rows:
+                if recurrence is not None:
+                    self._series[interval_id] = (start_time, end_time, recurrence, recurrence.last_end(start_time, end_time))
+                    continue
+                self._intervals[interval_id] = (start_time, end_time)
+                self._starts.append((start_time, interval_id))
+                self._max_span = max(self._max_span, end_time - start_time)
+            self._starts.sort()
+
+    def add(self, interval_id, start_time, end_time, recurrence=None):
+        with self._lock:
+            self._discard(interval_id)
+            if recurrence is not None:
+                self._series[interval_id] = (start_time, end_time, recurrence, recurrence.last_end(start_time, end_time))
+                return
+            self._intervals[interval_id] = (start_time, end_time)
+            insort(self._starts, (start_time, interval_id))
+            self._max_span = max(self._max_span, end_time - start_time)
+
+    def remove(self, interval_id):
+        with self._lock:
+            self._discard(interval_id)
+
+    def _discard(self, interval_id):
+        self._series.pop(interval_id, None)
+        interval = self._intervals.pop(interval_id, None)
+        if interval is not None:
+            position = bisect_left(self._starts, (interval[0], interval_id))
+            del self._starts[position]
+
+    # ids of intervals sharing at least one instant with [start_time, end_time]
+    # the longest span is never shrunk on removal, which only widens the probe
+    def overlapping(self, start_time, end_time, exclude_id=None):
+        with self._lock:
+            return self._overlapping(start_time, end_time, exclude_id)
+
+    # ids of intervals sharing an instant with any occurrence of a recurring interval up to horizon_end
+    def overlapping_series(self, start_time, end_time, recurrence, exclude_id=None, horizon_end=None):
+        conflicts = {}
+        with self._lock:
+            for occurrence_start, occurrence_end in recurrence.occurrences(start_time, end_time, window_end=horizon_end):
+                for interval_id in self._overlapping(occurrence_start, occurrence_end, exclude_id):
+                    conflicts.setdefault(interval_id)
+        return list(conflicts)
+
+    # (start_time, end_time) of every interval and occurrence sharing an instant with [start_time, end_time],
+    # ordered by start time
+    def intervals(self, start_time, end_time):
+        with self._lock:
+            low = bisect_left(self._starts, (start_time - self._max_span,))
+            high = bisect_right(self._starts, (end_time, float('inf')))
+            found = [self._intervals[interval_id] for _, interval_id in self._starts[low:high]
+                     if self._intervals[interval_id][1] >= start_time]
+            for series_start, series_end, recurrence, last_end in self._series.values():
+                if series_start > end_time or (last_end is not None and last_end < start_time):
+                    continue
+                found.extend(recurrence.occurrences(series_start, series_end, start_time, end_time))
+        found.sort()
+        return found
+
+    def _overlapping(self, start_time, end_time, exclude_id):
+        low = bisect_left(self._starts, (start_time - self._max_span,))
+        high = bisect_right(self._starts, (end_time, float('inf')))
+        conflicts = []
+        for _, interval_id in self._starts[low:high]:
+            if interval_id == exclude_id:
+                continue
+            if self._intervals[interval_id][1] >= start_time:
+                conflicts.append(interval_id)
+        for interval_id, (series_start, series_end, recurrence, last_end) in self._series.items():
+            if interval_id == exclude_id or series_start > end_time or (last_end is not None and last_end < start_time):
+                continue
+            if next(recurrence.occurrences(series_start, series_end, start_time, end_time), None) is not None:
+                conflicts.append(interval_id)
+        return conflicts
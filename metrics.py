@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Request timing, SQL accounting and Prometheus exposition for the events API.
+
+Helpers on the hot path are wrapped in named spans. Every span, SQL statement
+and request is added to process-wide histograms served by /metrics, and the
+spans and statements of the current request are also collected in a trace, so
+a slow response can be attributed to SQL, geocoding, 7timer, Nager.Date or
+chart rendering from its Server-Timing header or timing log line. A fraction of
+requests can be run under cProfile, each one dumped to a .prof file.
+"""
+import contextlib
+import contextvars
+import cProfile
+import functools
+import os
+import random
+import re
+import threading
+import time
+
+from sqlalchemy import event
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROFILE_RATE = float(os.environ.get('EVENTS_PROFILE_RATE', 0))   # fraction of requests profiled, 0 turns it off
+PROFILE_DIR = os.environ.get('EVENTS_PROFILE_DIR', 'profiles')
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class Histogram:
+
+    def __init__(self, name, description, label_names, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}   # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' histogram']
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for label_values, values in series:
+            labels = list(zip(self.label_names, label_values))
+            for bound, count in zip(self.buckets, values):
+                lines.append(self.name + '_bucket' + _labels(labels + [('le', repr(float(bound)))]) + ' ' + str(count))
+            lines.append(self.name + '_bucket' + _labels(labels + [('le', '+Inf')]) + ' ' + str(values[-1]))
+            lines.append(self.name + '_sum' + _labels(labels) + ' ' + repr(float(values[-2])))
+            lines.append(self.name + '_count' + _labels(labels) + ' ' + str(values[-1]))
+        return lines
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+request_seconds = Histogram('events_request_seconds', 'Time spent serving requests.', ('method', 'endpoint', 'status'))
+request_queries = Histogram('events_request_sql_queries', 'SQL statements issued per request.', ('endpoint',),
+                            buckets=(0, 1, 2, 3, 5, 10, 25, 50, 100))
+span_seconds = Histogram('events_span_seconds', 'Time spent in instrumented helpers.', ('span',))
+sql_seconds = Histogram('events_sql_seconds', 'Time spent executing SQL statements.', ('statement',))
+
+
+# spans and SQL statements of one request
+class Trace:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}      # name -> [calls, seconds]
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+
+    def add_span(self, name, seconds):
+        span = self.spans.setdefault(name, [0, 0.0])
+        span[0] += 1
+        span[1] += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    # Server-Timing header value, durations in milliseconds
+    def server_timing(self):
+        entries = ['%s;dur=%.3f;desc="%d calls"' % (name, seconds * 1000, calls)
+                   for name, (calls, seconds) in self.spans.items()]
+        entries.append('sql;dur=%.3f;desc="%d queries"' % (self.sql_seconds * 1000, self.sql_count))
+        entries.append('total;dur=%.3f' % (self.elapsed() * 1000))
+        return ', '.join(entries)
+
+    def as_dict(self):
+        return {
+            'duration_ms': round(self.elapsed() * 1000, 3),
+            'sql_queries': self.sql_count,
+            'sql_ms': round(self.sql_seconds * 1000, 3),
+            'spans': {name: {'calls': calls, 'ms': round(seconds * 1000, 3)} for name, (calls, seconds) in self.spans.items()},
+        }
+
+
+def start_trace():
+    trace = Trace()
+    return trace, _current_trace.set(trace)
+
+
+def finish_trace(token, method, endpoint, status):
+    trace = _current_trace.get()
+    _current_trace.reset(token)
+    if trace is not None:
+        request_seconds.observe(trace.elapsed(), method, endpoint, str(status))
+        request_queries.observe(trace.sql_count, endpoint)
+    return trace
+
+
+@contextlib.contextmanager
+def span(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        span_seconds.observe(seconds, name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(name, seconds)
+
+
+# decorator form of span, named after the function
+def timed(function):
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+# time every statement run on the engine, per statement kind and per request
+def instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def finish_statement(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['statement_started'].pop()
+        sql_seconds.observe(seconds, statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'EMPTY')
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.sql_count += 1
+            trace.sql_seconds += seconds
+
+    # a failed statement never reaches after_cursor_execute
+    @event.listens_for(engine, 'handle_error')
+    def discard_statement(context):
+        started = context.connection.info.get('statement_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+# Prometheus text exposition of the histograms, extra holds (name, type, description, value) samples
+def render(extra=()):
+    lines = []
+    for name, metric_type, description, value in extra:
+        lines += ['# HELP ' + name + ' ' + description, '# TYPE ' + name + ' ' + metric_type, name + ' ' + str(value)]
+    for histogram in (request_seconds, request_queries, span_seconds, sql_seconds):
+        lines += histogram.render()
+    return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+
+    def __init__(self, rate=PROFILE_RATE, directory=PROFILE_DIR):
+        self.rate = rate
+        self.directory = directory
+        # only one profiler can be active per process, concurrent requests are not sampled meanwhile
+        self._busy = threading.Lock()
+
+    # a started cProfile.Profile for a sampled request, or None
+    def start(self):
+        if self.rate <= 0 or random.random() >= self.rate or not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiling tool is active
+            self._busy.release()
+            return None
+        return profile
+
+    def stop(self, profile, label):
+        try:
+            profile.disable()
+        finally:
+            self._busy.release()
+        os.makedirs(self.directory, exist_ok=True)
+        filename = time.strftime('%Y%m%d-%H%M%S') + '-%06d-' % random.randrange(10 ** 6) + _UNSAFE.sub('_', label).strip('_') + '.prof'
+        path = os.path.join(self.directory, filename)
+        profile.dump_stats(path)
+        return path
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Recurrence rules for repeating events.
+
+A recurring event is stored once, as its first occurrence plus an RRULE subset
+(FREQ=DAILY|WEEKLY|MONTHLY with INTERVAL and COUNT or UNTIL) and a list of
+excluded dates. Occurrences are produced lazily by a generator that starts at
+the requested window, so nothing is materialised beyond what a caller reads.
+"""
+from datetime import datetime, timedelta, MAXYEAR
+
+FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY')
+MAX_INTERVAL = 1000
+MAX_COUNT = 10000
+RECURRENCE_HORIZON = timedelta(days=366)   # how far rules without an end are expanded for conflicts and statistics
+
+
+class Recurrence:
+
+    def __init__(self, freq, interval=1, count=None, until=None, exdates=()):
+        self.freq = freq
+        self.interval = interval
+        self.count = count
+        self.until = until
+        self.exdates = frozenset(exdates)
+
+    def __repr__(self):
+        return "<Recurrence ('%s')>" % self.rule
+
+    # 'FREQ=WEEKLY;INTERVAL=2;COUNT=10' and 'YYYY-MM-DD,...' (or a list of dates), raises ValueError
+    @classmethod
+    def parse(cls, rule, exdates=None):
+        parts = {}
+        for part in str(rule).upper().replace('RRULE:', '').split(';'):
+            if not part.strip():
+                continue
+            name, sep, value = part.partition('=')
+            if not sep or name.strip() in parts:
+                raise ValueError('malformed rule part ' + part)
+            parts[name.strip()] = value.strip()
+
+        freq = parts.pop('FREQ', None)
+        if freq not in FREQUENCIES:
+            raise ValueError('FREQ must be one of ' + ', '.join(FREQUENCIES))
+        try:
+            interval = int(parts.pop('INTERVAL', 1))
+            count = int(parts['COUNT']) if 'COUNT' in parts else None
+        except ValueError:
+            raise ValueError('INTERVAL and COUNT must be integers')
+        parts.pop('COUNT', None)
+        until = parts.pop('UNTIL', None)
+        if parts:
+            raise ValueError('unsupported rule parts ' + ', '.join(sorted(parts)))
+        if not 1 <= interval <= MAX_INTERVAL or (count is not None and count < 1):
+            raise ValueError('INTERVAL and COUNT must be positive')
+        if count is not None and count > MAX_COUNT:
+            raise ValueError('COUNT must be at most ' + str(MAX_COUNT))
+        if count is not None and until is not None:
+            raise ValueError('COUNT and UNTIL cannot be combined')
+        if until is not None:
+            until = parse_until(until)
+
+        if isinstance(exdates, str):
+            exdates = [d for d in exdates.split(',') if d.strip()]
+        try:
+            exdates = [datetime.strptime(str(d).strip(), '%Y-%m-%d').date() for d in exdates or ()]
+        except ValueError:
+            raise ValueError('exceptions must be dates formatted YYYY-MM-DD')
+        return cls(freq, interval, count, until, exdates)
+
+    # canonical rule text, as stored in the events table
+    @property
+    def rule(self):
+        rule = 'FREQ=' + self.freq
+        if self.interval != 1:
+            rule += ';INTERVAL=' + str(self.interval)
+        if self.count is not None:
+            rule += ';COUNT=' + str(self.count)
+        if self.until is not None:
+            rule += ';UNTIL=' + self.until.strftime('%Y%m%dT%H%M%S')
+        return rule
+
+    @property
+    def exceptions(self):
+        return sorted(d.strftime('%Y-%m-%d') for d in self.exdates)
+
+    # (start, end) of every occurrence sharing an instant with [window_start, window_end], in order;
+    # without window_end the generator only ends with the rule, callers bound unbounded rules themselves
+    def occurrences(self, start_time, end_time, window_start=None, window_end=None):
+        duration = end_time - start_time
+        earliest = None if window_start is None else window_start - duration
+        for n, occurrence in self._starts(start_time, earliest):
+            if self.count is not None and n >= self.count:
+                return
+            if self.until is not None and occurrence > self.until:
+                return
+            if window_end is not None and occurrence > window_end:
+                return
+            if earliest is not None and occurrence < earliest:
+                continue
+            if occurrence.date() in self.exdates:
+                continue
+            yield occurrence, occurrence + duration
+
+    # end of the last occurrence, None when the rule never ends; excluded dates are not
+    # subtracted, so this is an upper bound used to pre-select rules by date range
+    # raises ValueError when the last occurrence would end after the year MAXYEAR
+    def last_end(self, start_time, end_time):
+        if self.count is None and self.until is None:
+            return None
+        if self.freq == 'MONTHLY':
+            last = end_time
+            for n, occurrence in self._starts(start_time):
+                if (self.count is not None and n >= self.count) or (self.until is not None and occurrence > self.until):
+                    break
+                last = occurrence + (end_time - start_time)
+            return last
+        step = self._step()
+        n = self.count - 1 if self.count is not None else (self.until - start_time) // step
+        try:
+            return end_time + max(n, 0) * step
+        except OverflowError:
+            raise ValueError('the rule ends after the year ' + str(MAXYEAR))
+
+    def _step(self):
+        return timedelta(days=self.interval) if self.freq == 'DAILY' else timedelta(weeks=self.interval)
+
+    # (occurrence number, start) of the candidate occurrences, daily and weekly rules jump
+    # straight to the first one starting at or after `earliest`
+    def _starts(self, start_time, earliest=None):
+        if self.freq == 'MONTHLY':
+            n = 0
+            month = start_time.year * 12 + start_time.month - 1
+            while month // 12 <= MAXYEAR:
+                try:
+                    occurrence = start_time.replace(year=month // 12, month=month % 12 + 1)
+                except ValueError:
+                    # the day does not exist in this month, which is not an occurrence
+                    month += self.interval
+                    continue
+                yield n, occurrence
+                n += 1
+                month += self.interval
+            return
+
+        step = self._step()
+        n = 0
+        if earliest is not None and earliest > start_time:
+            n = -((start_time - earliest) // step)
+        try:
+            while True:
+                yield n, start_time + n * step
+                n += 1
+        except OverflowError:
+            return
+
+
+# UNTIL as YYYYMMDD (the whole day) or YYYYMMDDTHHMMSS, a trailing Z is ignored
+def parse_until(value):
+    value = value.rstrip('Z')
+    try:
+        if 'T' in value:
+            return datetime.strptime(value, '%Y%m%dT%H%M%S')
+        return datetime.strptime(value, '%Y%m%d') + timedelta(days=1, microseconds=-1)
+    except ValueError:
+        raise ValueError('UNTIL must be formatted YYYYMMDD or YYYYMMDDTHHMMSS')
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Database configuration and schema migrations for the events store.
+
+The database URL comes from EVENTS_DATABASE_URL (SQLite file by default).
+Startup never drops data: tables are created when missing and numbered
+migrations bring an existing database up to date. On PostgreSQL overlapping
+events are rejected by an exclusion constraint, on SQLite by triggers probing
+an R*Tree index of the event intervals.
+"""
+from datetime import datetime
+import logging
+import os
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+DATABASE_URL = os.environ.get('EVENTS_DATABASE_URL', 'sqlite+pysqlite:///events.db')
+SQL_ECHO = os.environ.get('EVENTS_SQL_ECHO', '0') == '1'   # statement logging is costly, opt in for debugging
+# connection pool sizing, one connection per concurrently served request
+DB_POOL_SIZE = int(os.environ.get('EVENTS_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('EVENTS_DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.environ.get('EVENTS_DB_POOL_TIMEOUT', 30))
+SQLITE_BUSY_TIMEOUT = 5000  # milliseconds a writer waits for the database lock
+DEFAULT_CALENDAR_ID = 1     # calendar of the events stored before calendars existed
+# drivers used by the async serving mode, EVENTS_ASYNC_DATABASE_URL overrides the derived URL
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg', 'mysql': 'mysql+aiomysql'}
+ASYNC_DATABASE_URL = os.environ.get('EVENTS_ASYNC_DATABASE_URL')
+
+logger = logging.getLogger(__name__)
+
+
+def make_engine(url=DATABASE_URL, echo=SQL_ECHO):
+    if not url.startswith('sqlite'):
+        return create_engine(url, echo=echo, future=True, pool_size=DB_POOL_SIZE,
+                             max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                             pool_pre_ping=True)
+
+    engine = create_engine(url, echo=echo, future=True,
+                           poolclass=QueuePool, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                           pool_timeout=DB_POOL_TIMEOUT, connect_args={'check_same_thread': False})
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+
+# the async flavour of a database URL, e.g. sqlite+pysqlite:///events.db -> sqlite+aiosqlite:///events.db
+def async_url(url):
+    scheme, rest = url.split('://', 1)
+    return ASYNC_DRIVERS.get(scheme.split('+')[0], scheme) + '://' + rest
+
+
+def make_async_engine(url=None, echo=SQL_ECHO):
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = url or ASYNC_DATABASE_URL or async_url(DATABASE_URL)
+    engine = create_async_engine(url, echo=echo, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                                 pool_timeout=DB_POOL_TIMEOUT, pool_pre_ping=not url.startswith('sqlite'))
+    if url.startswith('sqlite'):
+        event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+    return engine
+
+
+# WAL lets readers proceed while a write is in progress
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.execute('PRAGMA busy_timeout=' + str(SQLITE_BUSY_TIMEOUT))
+    cursor.close()
+
+
+# SQLite takes its write lock at the first write of a transaction, so what was read before it may be stale by then;
+# BEGIN IMMEDIATE takes the lock up front, other writers wait for it up to the busy timeout
+def begin_immediate(connection):
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+# migrations - each runs once per database, in order, inside one transaction
+def index_events_by_time(connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_events_start_end ON events (start_time, end_time)"))
+
+
+SQLITE_EPOCH = "CAST(strftime('%s', {}) AS INTEGER)"
+
+# the R*Tree stores 32 bit floats rounded outwards, so it only pre-selects candidates
+# and the exact check runs against the events table
+SQLITE_OVERLAP_PROBE = """
+    SELECT 1 FROM events_rtree r JOIN events e ON e.id = r.id
+    WHERE r.start_time <= {new_end} AND r.end_time >= {new_start}
+      AND e.start_time <= NEW.end_time AND e.end_time >= NEW.start_time
+""".format(new_start=SQLITE_EPOCH.format('NEW.start_time'), new_end=SQLITE_EPOCH.format('NEW.end_time'))
+
+SQLITE_OVERLAP_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS events_rtree USING rtree(id, start_time, end_time)",
+    "INSERT INTO events_rtree SELECT id, {}, {} FROM events WHERE id NOT IN (SELECT id FROM events_rtree)".format(
+        SQLITE_EPOCH.format('start_time'), SQLITE_EPOCH.format('end_time')),
+    """CREATE TRIGGER IF NOT EXISTS events_no_overlap_insert BEFORE INSERT ON events
+       WHEN EXISTS ({probe})
+       BEGIN SELECT RAISE(ABORT, 'events overlap'); END""".format(probe=SQLITE_OVERLAP_PROBE),
+    """CREATE TRIGGER IF NOT EXISTS events_no_overlap_update BEFORE UPDATE OF start_time, end_time ON events
+       WHEN EXISTS ({probe} AND e.id != NEW.id)
+       BEGIN SELECT RAISE(ABORT, 'events overlap'); END""".format(probe=SQLITE_OVERLAP_PROBE),
+    """CREATE TRIGGER IF NOT EXISTS events_rtree_insert AFTER INSERT ON events
+       BEGIN INSERT INTO events_rtree VALUES (NEW.id, {}, {}); END""".format(
+        SQLITE_EPOCH.format('NEW.start_time'), SQLITE_EPOCH.format('NEW.end_time')),
+    """CREATE TRIGGER IF NOT EXISTS events_rtree_update AFTER UPDATE OF start_time, end_time ON events
+       BEGIN UPDATE events_rtree SET start_time = {}, end_time = {} WHERE id = NEW.id; END""".format(
+        SQLITE_EPOCH.format('NEW.start_time'), SQLITE_EPOCH.format('NEW.end_time')),
+    """CREATE TRIGGER IF NOT EXISTS events_rtree_delete AFTER DELETE ON events
+       BEGIN DELETE FROM events_rtree WHERE id = OLD.id; END""",
+]
+
+
+def enforce_no_overlap(connection):
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text(
+            "ALTER TABLE events ADD CONSTRAINT events_no_overlap "
+            "EXCLUDE USING gist (tsrange(start_time, end_time, '[]') WITH &&)"))
+    elif dialect == 'sqlite':
+        try:
+            connection.execute(text(SQLITE_OVERLAP_DDL[0]))
+        except OperationalError:
+            logger.warning('SQLite is built without R*Tree support, relying on application checks')
+            return
+        for statement in SQLITE_OVERLAP_DDL[1:]:
+            connection.execute(text(statement))
+    else:
+        logger.warning('no overlap constraint available on %s, relying on application checks', dialect)
+
+
+# a recurring event is one row holding its first occurrence, the rule and the end of its last occurrence
+def add_recurrence(connection):
+    existing = {column['name'] for column in inspect(connection).get_columns('events')}
+    timestamp = 'DATETIME' if connection.dialect.name == 'sqlite' else 'TIMESTAMP'
+    for column, column_type in (('rrule', 'VARCHAR'), ('exdates', 'VARCHAR'), ('series_end', timestamp)):
+        if column not in existing:
+            connection.execute(text("ALTER TABLE events ADD COLUMN " + column + " " + column_type))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_events_recurring ON events (start_time) WHERE rrule IS NOT NULL"))
+
+
+# the description index is an external content FTS5 table kept in sync by triggers
+SQLITE_TEXT_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS events_fts USING fts5(description, content='events', content_rowid='id')",
+    "INSERT INTO events_fts (events_fts) VALUES ('rebuild')",
+    """CREATE TRIGGER IF NOT EXISTS events_fts_insert AFTER INSERT ON events
+       BEGIN INSERT INTO events_fts (rowid, description) VALUES (NEW.id, NEW.description); END""",
+    """CREATE TRIGGER IF NOT EXISTS events_fts_delete AFTER DELETE ON events
+       BEGIN INSERT INTO events_fts (events_fts, rowid, description) VALUES ('delete', OLD.id, OLD.description); END""",
+    """CREATE TRIGGER IF NOT EXISTS events_fts_update AFTER UPDATE OF description ON events
+       BEGIN INSERT INTO events_fts (events_fts, rowid, description) VALUES ('delete', OLD.id, OLD.description);
+             INSERT INTO events_fts (rowid, description) VALUES (NEW.id, NEW.description); END""",
+]
+
+
+# indexes behind the GET /events predicates
+def index_event_filters(connection):
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_events_state_start ON events (state, start_time)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_events_suburb ON events (lower(suburb))"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_events_name ON events (lower(name))"))
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_events_description_fts ON events "
+            "USING gin (to_tsvector('simple', coalesce(description, '')))"))
+    elif dialect == 'sqlite':
+        try:
+            connection.execute(text(SQLITE_TEXT_DDL[0]))
+        except OperationalError:
+            logger.warning('SQLite is built without FTS5 support, description search scans the table')
+            return
+        for statement in SQLITE_TEXT_DDL[1:]:
+            connection.execute(text(statement))
+
+
+# events only conflict within their calendar, the calendar id is a second R*Tree dimension
+SQLITE_CALENDAR_OVERLAP_PROBE = """
+    SELECT 1 FROM events_rtree r JOIN events e ON e.id = r.id
+    WHERE r.start_time <= {new_end} AND r.end_time >= {new_start}
+      AND r.calendar_lo <= NEW.calendar_id AND r.calendar_hi >= NEW.calendar_id
+      AND e.calendar_id = NEW.calendar_id
+      AND e.start_time <= NEW.end_time AND e.end_time >= NEW.start_time
+""".format(new_start=SQLITE_EPOCH.format('NEW.start_time'), new_end=SQLITE_EPOCH.format('NEW.end_time'))
+
+SQLITE_CALENDAR_OVERLAP_DDL = [
+    "CREATE VIRTUAL TABLE events_rtree USING rtree(id, start_time, end_time, calendar_lo, calendar_hi)",
+    "INSERT INTO events_rtree SELECT id, {}, {}, calendar_id, calendar_id FROM events".format(
+        SQLITE_EPOCH.format('start_time'), SQLITE_EPOCH.format('end_time')),
+    """CREATE TRIGGER events_no_overlap_insert BEFORE INSERT ON events
+       WHEN EXISTS ({probe})
+       BEGIN SELECT RAISE(ABORT, 'events overlap'); END""".format(probe=SQLITE_CALENDAR_OVERLAP_PROBE),
+    """CREATE TRIGGER events_no_overlap_update BEFORE UPDATE OF start_time, end_time, calendar_id ON events
+       WHEN EXISTS ({probe} AND e.id != NEW.id)
+       BEGIN SELECT RAISE(ABORT, 'events overlap'); END""".format(probe=SQLITE_CALENDAR_OVERLAP_PROBE),
+    """CREATE TRIGGER events_rtree_insert AFTER INSERT ON events
+       BEGIN INSERT INTO events_rtree VALUES (NEW.id, {}, {}, NEW.calendar_id, NEW.calendar_id); END""".format(
+        SQLITE_EPOCH.format('NEW.start_time'), SQLITE_EPOCH.format('NEW.end_time')),
+    """CREATE TRIGGER events_rtree_update AFTER UPDATE OF start_time, end_time, calendar_id ON events
+       BEGIN UPDATE events_rtree SET start_time = {}, end_time = {}, calendar_lo = NEW.calendar_id,
+             calendar_hi = NEW.calendar_id WHERE id = NEW.id; END""".format(
+        SQLITE_EPOCH.format('NEW.start_time'), SQLITE_EPOCH.format('NEW.end_time')),
+    """CREATE TRIGGER events_rtree_delete AFTER DELETE ON events
+       BEGIN DELETE FROM events_rtree WHERE id = OLD.id; END""",
+]
+
+
+# every event belongs to a calendar, existing events move into the default one
+def partition_by_calendar(connection):
+    dialect = connection.dialect.name
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS calendars (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, owner VARCHAR)"))
+    if connection.execute(text("SELECT 1 FROM calendars WHERE id = :id"), {'id': DEFAULT_CALENDAR_ID}).first() is None:
+        connection.execute(text("INSERT INTO calendars (id, name) VALUES (:id, 'default')"), {'id': DEFAULT_CALENDAR_ID})
+    if 'calendar_id' not in {column['name'] for column in inspect(connection).get_columns('events')}:
+        # SQLite cannot add a REFERENCES column with a default, the model still declares the foreign key
+        reference = '' if dialect == 'sqlite' else ' REFERENCES calendars (id)'
+        connection.execute(text(
+            "ALTER TABLE events ADD COLUMN calendar_id INTEGER NOT NULL DEFAULT {}{}".format(DEFAULT_CALENDAR_ID, reference)))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_events_calendar_start ON events (calendar_id, start_time)"))
+
+    if dialect == 'postgresql':
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gist"))
+        connection.execute(text("ALTER TABLE events DROP CONSTRAINT IF EXISTS events_no_overlap"))
+        connection.execute(text(
+            "ALTER TABLE events ADD CONSTRAINT events_no_overlap "
+            "EXCLUDE USING gist (calendar_id WITH =, tsrange(start_time, end_time, '[]') WITH &&)"))
+    elif dialect == 'sqlite' and 'events_rtree' in inspect(connection).get_table_names():
+        for trigger in ('events_no_overlap_insert', 'events_no_overlap_update',
+                        'events_rtree_insert', 'events_rtree_update', 'events_rtree_delete'):
+            connection.execute(text("DROP TRIGGER IF EXISTS " + trigger))
+        connection.execute(text("DROP TABLE events_rtree"))
+        for statement in SQLITE_CALENDAR_OVERLAP_DDL:
+            connection.execute(text(statement))
+
+
+# every update of an event bumps its version, ETags and conditional writes are derived from it
+def add_row_versions(connection):
+    if 'version' not in {column['name'] for column in inspect(connection).get_columns('events')}:
+        connection.execute(text("ALTER TABLE events ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+
+
+# CROSS JOIN fixes the R*Tree as the outer table, otherwise SQLite drives the probe from ix_events_calendar_start
+# and walks every earlier event of the calendar on each insert
+SQLITE_RTREE_OVERLAP_PROBE = SQLITE_CALENDAR_OVERLAP_PROBE.replace(
+    'FROM events_rtree r JOIN events e', 'FROM events_rtree r CROSS JOIN events e')
+
+SQLITE_RTREE_OVERLAP_DDL = [
+    """CREATE TRIGGER events_no_overlap_insert BEFORE INSERT ON events
+       WHEN EXISTS ({probe})
+       BEGIN SELECT RAISE(ABORT, 'events overlap'); END""".format(probe=SQLITE_RTREE_OVERLAP_PROBE),
+    """CREATE TRIGGER events_no_overlap_update BEFORE UPDATE OF start_time, end_time, calendar_id ON events
+       WHEN EXISTS ({probe} AND e.id != NEW.id)
+       BEGIN SELECT RAISE(ABORT, 'events overlap'); END""".format(probe=SQLITE_RTREE_OVERLAP_PROBE),
+]
+
+
+def probe_overlaps_by_rtree(connection):
+    if connection.dialect.name != 'sqlite' or 'events_rtree' not in inspect(connection).get_table_names():
+        return
+    for trigger in ('events_no_overlap_insert', 'events_no_overlap_update'):
+        connection.execute(text("DROP TRIGGER IF EXISTS " + trigger))
+    for statement in SQLITE_RTREE_OVERLAP_DDL:
+        connection.execute(text(statement))
+
+
+MIGRATIONS = [
+    (1, 'index events by start and end time', index_events_by_time),
+    (2, 'reject overlapping events in the database', enforce_no_overlap),
+    (3, 'store recurrence rules of repeating events', add_recurrence),
+    (4, 'index the event list filters', index_event_filters),
+    (5, 'partition events by calendar', partition_by_calendar),
+    (6, 'track row versions of events', add_row_versions),
+    (7, 'probe overlapping events through the R*Tree', probe_overlaps_by_rtree),
+]
+
+
+def migrate(engine):
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations "
+            "(version INTEGER PRIMARY KEY, description VARCHAR, applied_at TIMESTAMP)"))
+        applied = {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+    for version, description, apply in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as connection:
+            apply(connection)
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)"),
+                {'v': version, 'd': description, 't': datetime.now()})
+        logger.info('applied migration %s: %s', version, description)
+
+
+def has_overlap_index(engine):
+    return engine.dialect.name == 'sqlite' and 'events_rtree' in inspect(engine).get_table_names()
+
+
+def has_text_index(engine):
+    return engine.dialect.name == 'sqlite' and 'events_fts' in inspect(engine).get_table_names()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Shared HTTP access to the external APIs (7timer, Nager.Date).
+
+All upstream calls go through one pooled requests session and always carry a
+timeout, so a slow upstream can no longer hold a worker thread indefinitely.
+
+The base URLs can be pointed at fakeupstream.py, and EVENTS_UPSTREAM_CASSETTE
+turns on record/replay: in 'record' mode every successful response is also
+written to the cassette file, in 'replay' mode responses come only from the
+cassette and a request it does not hold fails like an unreachable upstream.
+"""
+import json
+import os
+import threading
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TIMEOUT = 3  # seconds, (connect, read) share the same budget
+POOL_SIZE = 16
+SEVENTIMER_BASE_URL = os.environ.get('EVENTS_SEVENTIMER_BASE_URL', 'http://www.7timer.info').rstrip('/')
+NAGER_BASE_URL = os.environ.get('EVENTS_NAGER_BASE_URL', 'https://date.nager.at').rstrip('/')
+CASSETTE_PATH = os.environ.get('EVENTS_UPSTREAM_CASSETTE')
+CASSETTE_MODE = os.environ.get('EVENTS_UPSTREAM_MODE', 'replay')   # record or replay, with a cassette
+CASSETTE_MODES = ('record', 'replay')
+
+http = requests.Session()
+http.mount('http://', HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+http.mount('https://', HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+
+
+# a request the replayed cassette does not hold
+class CassetteMiss(requests.ConnectionError):
+    pass
+
+
+class Cassette:
+
+    def __init__(self, path, mode='replay'):
+        if mode not in CASSETTE_MODES:
+            raise ValueError('cassette mode must be one of ' + ', '.join(CASSETTE_MODES))
+        self.path = path
+        self.mode = mode
+        self._interactions = {}   # request key -> {'url', 'params', 'response'}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for interaction in json.load(f)['interactions']:
+                    self._interactions[self.key(interaction['url'], interaction['params'])] = interaction
+        elif mode == 'replay':
+            raise FileNotFoundError('no cassette at ' + path)
+
+    # the same request always gives the same key, whatever order its parameters come in
+    @staticmethod
+    def key(url, params=None):
+        params = sorted((str(name), str(value)) for name, value in (params or {}).items())
+        return url + ('?' + urlencode(params) if params else '')
+
+    def replay(self, url, params=None):
+        try:
+            return self._interactions[self.key(url, params)]['response']
+        except KeyError:
+            raise CassetteMiss('not in cassette ' + self.path + ': ' + self.key(url, params))
+
+    def record(self, url, params, document):
+        with self._lock:
+            self._interactions[self.key(url, params)] = {
+                'url': url, 'params': {str(name): str(value) for name, value in (params or {}).items()},
+                'response': document}
+            interactions = [self._interactions[key] for key in sorted(self._interactions)]
+            # written whole and swapped in, so an interrupted run never leaves a truncated cassette
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'interactions': interactions}, f, indent=1)
+            os.replace(self.path + '.tmp', self.path)
+
+
+cassette = Cassette(CASSETTE_PATH, CASSETTE_MODE) if CASSETTE_PATH else None
+
+
+# GET a json document, raises requests.RequestException on timeout or non-2xx status
+def get_json(url, params=None, timeout=DEFAULT_TIMEOUT):
+    if cassette is not None and cassette.mode == 'replay':
+        return cassette.replay(url, params)
+    response = http.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    document = response.json()
+    if cassette is not None:
+        cassette.record(url, params, document)
+    return document
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Cached access to the 7timer forecast API.
+
+Forecasts are cached per rounded grid cell with a TTL and LRU eviction. Expired
+entries are still served for a grace period while a background refresh runs
+(stale-while-revalidate), so event reads never wait on 7timer for longer than
+WEATHER_MISS_WAIT seconds.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import logging
+import threading
+import time
+
+import requests
+
+from upstream import get_json, SEVENTIMER_BASE_URL
+
+SEVENTIMER_URL = SEVENTIMER_BASE_URL + "/bin/api.pl"
+WEATHER_TIMEOUT = 3              # seconds per upstream request
+WEATHER_TTL = 3 * 3600           # forecasts are re-issued every few hours
+WEATHER_STALE_TTL = 24 * 3600    # how long an expired forecast may still be served
+WEATHER_RETRY_AFTER = 60         # back-off after a failed refresh
+WEATHER_MISS_WAIT = 1.0          # how long a read may wait on an uncached cell
+WEATHER_CACHE_SIZE = 1024
+WEATHER_WORKERS = 8
+COORD_PRECISION = 2              # ~1km grid, well below 7timer's resolution
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_forecast(lat, lon, product='civil', timeout=WEATHER_TIMEOUT):
+    params = {'lon': lon, 'lat': lat, 'product': product, 'output': 'json'}
+    return get_json(SEVENTIMER_URL, params=params, timeout=timeout)
+
+
+class _Entry:
+    __slots__ = ('forecast', 'fetched_at')
+
+    def __init__(self, forecast, fetched_at):
+        self.forecast = forecast
+        self.fetched_at = fetched_at
+
+
+class WeatherCache:
+
+    def __init__(self, fetch=fetch_forecast, ttl=WEATHER_TTL, stale_ttl=WEATHER_STALE_TTL,
+                 max_entries=WEATHER_CACHE_SIZE, stale_while_revalidate=True,
+                 miss_wait=WEATHER_MISS_WAIT, retry_after=WEATHER_RETRY_AFTER,
+                 workers=WEATHER_WORKERS):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.stale_while_revalidate = stale_while_revalidate
+        self.miss_wait = miss_wait
+        self.retry_after = retry_after
+        self._entries = OrderedDict()   # key -> _Entry, least recently used first
+        self._inflight = {}             # key -> Future of a running refresh
+        self._failed_at = {}            # key -> time of the last failed refresh
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='weather')
+
+    @staticmethod
+    def key(lat, lon, product='civil'):
+        return (round(float(lat), COORD_PRECISION), round(float(lon), COORD_PRECISION), product)
+
+    # forecast document for the grid cell, or None when it is not available yet
+    def get(self, lat, lon, product='civil', wait=None):
+        return self.get_many([(lat, lon)], product, wait)[0]
+
+    # forecasts for several (lat, lon) cells, refreshed concurrently on the worker pool;
+    # cells that are still missing once `wait` seconds have passed come back as None
+    def get_many(self, locations, product='civil', wait=None):
+        if wait is None and self.stale_while_revalidate:
+            wait = self.miss_wait
+        results = [None] * len(locations)
+        pending = {}
+        now = time.monotonic()
+        with self._lock:
+            for i, (lat, lon) in enumerate(locations):
+                results[i], future = self._lookup(self.key(lat, lon, product), now)
+                if results[i] is None and future is not None:
+                    pending[i] = future
+
+        deadline = None if wait is None else time.monotonic() + wait
+        for i, future in pending.items():
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                results[i] = future.result(timeout=remaining)
+            except (FutureTimeout, requests.RequestException, ValueError):
+                pass
+        return results
+
+    # cached forecast (possibly stale) and the refresh future, if one was started
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            age = now - entry.fetched_at
+            if age < self.ttl:
+                return entry.forecast, None
+            if self.stale_while_revalidate and age < self.ttl + self.stale_ttl:
+                return entry.forecast, self._refresh(key, now)
+        return None, self._refresh(key, now)
+
+    def invalidate(self, lat=None, lon=None, product='civil'):
+        with self._lock:
+            if lat is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self.key(lat, lon, product), None)
+
+    # schedule a refresh of key unless one is running or the last one failed recently
+    def _refresh(self, key, now):
+        future = self._inflight.get(key)
+        if future is not None:
+            return future
+        failed_at = self._failed_at.get(key)
+        if failed_at is not None and now - failed_at < self.retry_after:
+            return None
+        future = self._executor.submit(self._load, key)
+        self._inflight[key] = future
+        return future
+
+    # cached forecast for key without scheduling a refresh, and whether a refresh is due;
+    # lets an event loop fetch with its own client and hand the result back through store()
+    def peek(self, key):
+        now = time.monotonic()
+        with self._lock:
+            failed_at = self._failed_at.get(key)
+            due = failed_at is None or now - failed_at >= self.retry_after
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, due
+            self._entries.move_to_end(key)
+            age = now - entry.fetched_at
+            if age < self.ttl:
+                return entry.forecast, False
+            if self.stale_while_revalidate and age < self.ttl + self.stale_ttl:
+                return entry.forecast, due
+            return None, due
+
+    def store(self, key, forecast):
+        with self._lock:
+            self._entries[key] = _Entry(forecast, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._failed_at.pop(key, None)
+
+    def fail(self, key):
+        with self._lock:
+            self._failed_at[key] = time.monotonic()
+
+    def _load(self, key):
+        lat, lon, product = key
+        try:
+            forecast = self.fetch(lat, lon, product)
+        except Exception as err:
+            logger.warning('weather refresh failed for %s: %s', key, err)
+            self.fail(key)
+            with self._lock:
+                self._inflight.pop(key, None)
+            raise
+        self.store(key, forecast)
+        with self._lock:
+            self._inflight.pop(key, None)
+        return forecast